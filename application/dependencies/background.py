@@ -0,0 +1,37 @@
+from functools import partial
+from logging import getLogger
+
+from eventlet.semaphore import Semaphore
+from nameko.extensions import DependencyProvider
+
+_log = getLogger(__name__)
+
+
+class Spawner(object):
+
+    def __init__(self, container, semaphore):
+        self.container = container
+        self.semaphore = semaphore
+
+    def _run(self, name, fn):
+        with self.semaphore:
+            try:
+                fn()
+            except Exception as exc:
+                _log.error('Background task {} failed: {}'.format(name, str(exc)))
+
+    def spawn(self, name, fn, *args, **kwargs):
+        return self.container.spawn_managed_thread(partial(self._run, name, partial(fn, *args, **kwargs)))
+
+
+class BackgroundTasks(DependencyProvider):
+    """ Runs low priority tasks in managed threads, at most BACKGROUND_CONCURRENCY of them at once.
+
+    Tasks outlive the worker which spawned them and are killed when the container stops.
+    """
+
+    def setup(self):
+        self.semaphore = Semaphore(self.container.config.get('BACKGROUND_CONCURRENCY', 2))
+
+    def get_dependency(self, worker_ctx):
+        return Spawner(self.container, self.semaphore)
@@ -0,0 +1,296 @@
+import gzip
+import json
+import os
+import time
+from collections import OrderedDict
+from logging import getLogger
+
+import eventlet
+from eventlet import tpool
+from nameko.extensions import DependencyProvider
+
+from application.dependencies.pictures import PictureStore
+
+_log = getLogger(__name__)
+
+DEFAULT_REGIONS = {
+    'query_results': {'maxsize': 1024, 'ttl': 3600, 'stale_ttl': 0, 'snapshot': False},
+    'events': {'maxsize': 1024, 'ttl': 300, 'stale_ttl': 30},
+    'entities': {'maxsize': 8192, 'ttl': 600, 'stale_ttl': 3600},
+    'pictures': {'maxsize': 2048, 'ttl': 3600, 'stale_ttl': 0},
+    'templates': {'maxsize': 512, 'ttl': 60, 'stale_ttl': 300},
+    'queries': {'maxsize': 1024, 'ttl': 300, 'stale_ttl': 3600},
+    'labels': {'maxsize': 8192, 'ttl': 3600, 'stale_ttl': 86400},
+    'subscriptions': {'maxsize': 1024, 'ttl': 300, 'stale_ttl': 3600, 'snapshot': False},
+    'records': {'maxsize': 8192, 'ttl': 3600, 'stale_ttl': 0, 'snapshot': False},
+    'datasources': {'maxsize': 4096, 'ttl': 86400, 'stale_ttl': 0, 'snapshot': False},
+    'renders': {'maxsize': 512, 'ttl': 900, 'stale_ttl': 0, 'snapshot': False},
+    'trigger_results': {'maxsize': 8192, 'ttl': 86400, 'stale_ttl': 0, 'snapshot': False}
+}
+SNAPSHOT_VERSION = 1
+SNAPSHOT_COMPRESSLEVEL = 1
+
+
+def _write_snapshot(path, snapshot, picture_store=None):
+    if picture_store is not None:
+        for entry in snapshot['regions'].get('pictures', []):
+            entry[1] = picture_store.put(entry[1])
+    tmp_path = '{}.tmp'.format(path)
+    with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=SNAPSHOT_COMPRESSLEVEL) as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+
+class TTLCache(object):
+    """ LRU cache whose entries expire ttl seconds after being set.
+
+    Expired entries are kept stale_ttl more seconds so that they can be served by get_entry while
+    being refreshed. Entries can be tagged so that a group of them is invalidated at once. A value computed
+    while one of its tags was invalidated is not stored when set is given the generation read before computing it.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, stale_ttl=0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.tags = dict()
+        self.refreshing = set()
+        self.invalidations = 0
+        self.invalidated = OrderedDict()
+        self.forgotten = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries and self.entries[key][0] > self.clock()
+
+    def has_entry(self, key):
+        """ Returns True for a fresh or stale entry, without counting a lookup """
+        entry = self.entries.get(key)
+        return entry is not None and entry[0] + self.stale_ttl > self.clock()
+
+    def get_entry(self, key):
+        """ Returns (value, stale) for a fresh or stale entry, (None, False) otherwise """
+        entry = self.entries.get(key)
+        now = self.clock()
+        if entry is None or entry[0] + self.stale_ttl <= now:
+            if entry is not None:
+                self.invalidate(key)
+            self.misses += 1
+            return None, False
+        self.entries.move_to_end(key)
+        if entry[0] <= now:
+            self.stale_hits += 1
+            return entry[1], True
+        self.hits += 1
+        return entry[1], False
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= self.clock():
+            if entry is not None and entry[0] + self.stale_ttl <= self.clock():
+                self.invalidate(key)
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def record_misses(self, count):
+        """ Counts lookups answered downstream without going through get or get_entry """
+        self.misses += count
+
+    def start_refresh(self, key):
+        """ Returns False when the entry is already being refreshed """
+        if key in self.refreshing:
+            return False
+        self.refreshing.add(key)
+        return True
+
+    def end_refresh(self, key):
+        self.refreshing.discard(key)
+
+    def generation(self):
+        """ Returns the current generation of the tags, see set """
+        return self.invalidations
+
+    def invalidated_since(self, tags, generation):
+        if generation < self.forgotten:
+            return True
+        return any(self.invalidated.get(tag, 0) > generation for tag in tags)
+
+    def set(self, key, value, tags=(), ttl=None, generation=None):
+        """ Stores a value, unless one of its tags was invalidated since the given generation """
+        if generation is not None and self.invalidated_since(tags, generation):
+            return False
+        self.invalidate(key)
+        self.entries[key] = (self.clock() + (self.ttl if ttl is None else ttl), value, tuple(tags))
+        for tag in tags:
+            self.tags.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.maxsize:
+            self.invalidate(next(iter(self.entries)))
+            self.evictions += 1
+        return True
+
+    def invalidate(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        for tag in entry[2]:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+        return True
+
+    def invalidate_tags(self, tags):
+        self.invalidations += 1
+        keys = set()
+        for tag in tags:
+            keys.update(self.tags.get(tag, ()))
+            self.invalidated[tag] = self.invalidations
+            self.invalidated.move_to_end(tag)
+        while len(self.invalidated) > self.maxsize:
+            self.forgotten = max(self.forgotten, self.invalidated.popitem(last=False)[1])
+        for key in keys:
+            self.invalidate(key)
+        return len(keys)
+
+    def clear(self):
+        self.invalidations += 1
+        self.forgotten = self.invalidations
+        self.entries.clear()
+        self.tags.clear()
+
+    def items(self):
+        """ Yields the live entries as (key, value, remaining ttl, tags) from the least to the most recently used """
+        now = self.clock()
+        for key, (expires_at, value, tags) in list(self.entries.items()):
+            if expires_at > now:
+                yield key, value, expires_at - now, tags
+
+    def stats(self):
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            'size': len(self.entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits + self.stale_hits) / lookups if lookups else None,
+            'evictions': self.evictions
+        }
+
+
+class Caches(object):
+    """ Named cache regions of the service, configured per region with maxsize, ttl, stale_ttl and snapshot """
+
+    def __init__(self, config=None, clock=time.monotonic):
+        self.regions = dict()
+        self.transient = set()
+        for name, defaults in DEFAULT_REGIONS.items():
+            options = dict(defaults, **((config or {}).get(name) or {}))
+            self.regions[name] = TTLCache(options['maxsize'], options['ttl'], options['stale_ttl'], clock=clock)
+            if not options.get('snapshot', True):
+                self.transient.add(name)
+
+    def __getitem__(self, name):
+        return self.regions[name]
+
+    def stats(self):
+        return dict((name, region.stats()) for name, region in self.regions.items())
+
+    def dump(self, path, picture_store=None):
+        """ Writes the live entries into a gzipped JSON snapshot, pictures are only kept as references to the store.
+
+        Entries are collected on the hub, then pictures are stored, and the snapshot encoded and compressed, in a
+        native thread.
+        """
+        regions = dict()
+        for name, region in self.regions.items():
+            if name in self.transient or (name == 'pictures' and picture_store is None):
+                continue
+            entries = list()
+            for key, value, remaining, tags in region.items():
+                entries.append([list(key), value, remaining, [list(t) for t in tags]])
+            regions[name] = entries
+        tpool.execute(_write_snapshot, path,
+                      {'version': SNAPSHOT_VERSION, 'created_at': time.time(), 'regions': regions}, picture_store)
+        return sum(len(v) for v in regions.values())
+
+    def load(self, path, max_age, picture_store=None):
+        """ Restores a snapshot not older than max_age seconds, entries keep the ttl they had left when dumped """
+        if not os.path.exists(path):
+            return 0
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            snapshot = json.load(f)
+        age = time.time() - snapshot['created_at']
+        if snapshot.get('version') != SNAPSHOT_VERSION or age > max_age:
+            _log.info('Ignoring cache snapshot {} ({:.0f}s old)'.format(path, age))
+            return 0
+        loaded = 0
+        for name, entries in snapshot['regions'].items():
+            if name not in self.regions or (name == 'pictures' and picture_store is None):
+                continue
+            for key, value, remaining, tags in entries:
+                if remaining <= age:
+                    continue
+                if name == 'pictures':
+                    value = picture_store.get(value)
+                self.regions[name].set(tuple(key), value, tags=[tuple(t) for t in tags], ttl=remaining - age)
+                loaded += 1
+        return loaded
+
+
+class ServiceCache(DependencyProvider):
+    """ Provides the Caches configured under CACHE, shared by all the workers of the container.
+
+    When CACHE_SNAPSHOT has a path, the caches are restored from it at start if it is not older than
+    max_age, then dumped into it every interval seconds and when the container stops.
+    """
+
+    def setup(self):
+        config = self.container.config
+        self.caches = Caches(config.get('CACHE'))
+        self.snapshot = config.get('CACHE_SNAPSHOT') or {}
+        picture_store_path = config.get('PICTURE_STORE_PATH')
+        self.picture_store = PictureStore(picture_store_path) if picture_store_path else None
+        self.snapshot_thread = None
+
+    def _dump_snapshot(self):
+        try:
+            dumped = self.caches.dump(self.snapshot['path'], self.picture_store)
+            _log.info('{} cache entries dumped into {}'.format(dumped, self.snapshot['path']))
+        except Exception as exc:
+            _log.error('Cache snapshot failed: {}'.format(str(exc)))
+
+    def _run_snapshots(self):
+        while True:
+            eventlet.sleep(self.snapshot.get('interval', 60))
+            self._dump_snapshot()
+
+    def start(self):
+        if not self.snapshot.get('path'):
+            return
+        try:
+            loaded = self.caches.load(self.snapshot['path'], self.snapshot.get('max_age', 900), self.picture_store)
+            _log.info('{} cache entries restored from {}'.format(loaded, self.snapshot['path']))
+        except Exception as exc:
+            _log.error('Cache snapshot {} not restored: {}'.format(self.snapshot['path'], str(exc)))
+        self.snapshot_thread = self.container.spawn_managed_thread(self._run_snapshots)
+
+    def stop(self):
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.kill()
+            self._dump_snapshot()
+
+    def get_dependency(self, worker_ctx):
+        return self.caches
@@ -0,0 +1,57 @@
+import base64
+import zlib
+
+from nameko.extensions import DependencyProvider
+
+ENVELOPE_KEY = '__compressed__'
+ENVELOPE_ENCODING = 'zlib+base64'
+
+
+class CompressionError(Exception):
+    pass
+
+
+def is_envelope(payload):
+    return isinstance(payload, dict) and ENVELOPE_KEY in payload
+
+
+def decode(payload):
+    """ Returns the text carried by a compression envelope, any other payload is returned as is """
+    if not is_envelope(payload):
+        return payload
+    if payload[ENVELOPE_KEY] != ENVELOPE_ENCODING:
+        raise CompressionError('Unsupported payload encoding: {}'.format(payload[ENVELOPE_KEY]))
+    return zlib.decompress(base64.b64decode(payload['data'])).decode('utf-8')
+
+
+class Codec(object):
+
+    def __init__(self, enabled=False, threshold=65536, level=1):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.level = level
+
+    def encode(self, payload):
+        if not self.enabled or not isinstance(payload, str) or len(payload) < self.threshold:
+            return payload
+        data = base64.b64encode(zlib.compress(payload.encode('utf-8'), self.level)).decode('ascii')
+        if len(data) >= len(payload):
+            return payload
+        return {ENVELOPE_KEY: ENVELOPE_ENCODING, 'data': data}
+
+    @staticmethod
+    def decode(payload):
+        return decode(payload)
+
+
+class PayloadCodec(DependencyProvider):
+    """ Provides the Codec configured under RPC_COMPRESSION (enabled, threshold, level) """
+
+    def setup(self):
+        config = self.container.config.get('RPC_COMPRESSION') or {}
+        self.codec = Codec(enabled=config.get('enabled', False),
+                           threshold=config.get('threshold', 65536),
+                           level=config.get('level', 1))
+
+    def get_dependency(self, worker_ctx):
+        return self.codec
@@ -0,0 +1,87 @@
+from nameko.extensions import DependencyProvider
+
+
+class StageStats(object):
+
+    def __init__(self):
+        self.processed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.busy_seconds = 0.
+        self.active_seconds = 0.
+
+    def enqueued(self):
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def dequeued(self):
+        self.queue_depth -= 1
+        self.in_flight += 1
+
+    def done(self, seconds, failed=False):
+        self.in_flight -= 1
+        self.busy_seconds += seconds
+        if failed:
+            self.failed += 1
+        else:
+            self.processed += 1
+
+    def to_dict(self):
+        return {
+            'processed': self.processed,
+            'failed': self.failed,
+            'in_flight': self.in_flight,
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'busy_seconds': self.busy_seconds,
+            'throughput': self.processed / self.active_seconds if self.active_seconds else None
+        }
+
+
+class Metrics(object):
+
+    def __init__(self, max_workers=None):
+        self.stages = dict()
+        self.max_workers = max_workers
+        self.in_flight = dict()
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = StageStats()
+        return self.stages[name]
+
+    def summary(self):
+        return dict((name, stats.to_dict()) for name, stats in self.stages.items())
+
+    def worker_started(self, entrypoint):
+        self.in_flight[entrypoint] = self.in_flight.get(entrypoint, 0) + 1
+
+    def worker_finished(self, entrypoint):
+        self.in_flight[entrypoint] -= 1
+
+    def workers(self):
+        active = sum(self.in_flight.values())
+        return {
+            'in_flight': dict(self.in_flight),
+            'active': active,
+            'max_workers': self.max_workers,
+            'usage': float(active) / self.max_workers if self.max_workers else None
+        }
+
+
+class ServiceMetrics(DependencyProvider):
+    """ Provides the Metrics of the pipeline stages and workers, shared by all the workers of the container """
+
+    def setup(self):
+        self.metrics = Metrics(self.container.max_workers)
+
+    def worker_setup(self, worker_ctx):
+        self.metrics.worker_started(worker_ctx.entrypoint.method_name)
+
+    def worker_teardown(self, worker_ctx):
+        self.metrics.worker_finished(worker_ctx.entrypoint.method_name)
+
+    def get_dependency(self, worker_ctx):
+        return self.metrics
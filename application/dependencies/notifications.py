@@ -0,0 +1,168 @@
+import time
+from logging import getLogger
+
+import eventlet
+from eventlet.semaphore import Semaphore
+from nameko.exceptions import MethodNotFound
+from nameko.extensions import DependencyProvider
+from nameko.standalone.rpc import ClusterRpcProxy
+
+_log = getLogger(__name__)
+
+
+class ChannelStats(object):
+
+    def __init__(self):
+        self.queued = 0
+        self.messages = 0
+        self.batches = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def to_dict(self):
+        return {
+            'queued': self.queued,
+            'messages': self.messages,
+            'batches': self.batches,
+            'failures': self.failures,
+            'dropped': self.dropped
+        }
+
+
+class Dispatcher(object):
+    """ Sends the Slack notifications of a channel in batches, paced by the channel rate.
+
+    Messages queued within window seconds are sent together, at most max_batch of them, and two sends to a
+    channel are at least min_interval seconds apart. The undelivered messages of a failed batch are queued again
+    up to retries times, the interval of its channel being doubled, up to max_interval, until the next successful
+    send.
+
+    Batches are sent with send_images_to_slack, if the notifier does not provide it messages are sent one by one
+    for unavailable_ttl seconds before batches are tried again. The notifier is called by one channel at a time.
+    """
+
+    def __init__(self, spawn, notifier=None, window=2., min_interval=1., max_interval=60., max_batch=10, retries=2,
+                 unavailable_ttl=300, sleep=eventlet.sleep, clock=time.monotonic):
+        self.spawn = spawn
+        self.notifier = notifier
+        self.window = window
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_batch = max_batch
+        self.retries = retries
+        self.unavailable_ttl = unavailable_ttl
+        self.sleep = sleep
+        self.clock = clock
+        self.pending = dict()
+        self.intervals = dict()
+        self.last_sent = dict()
+        self.stats = dict()
+        self.unavailable = dict()
+        self.sending = Semaphore()
+
+    def supports(self, method_name):
+        """ Returns False while the notifier is remembered as not providing the method """
+        until = self.unavailable.get(method_name)
+        if until is None:
+            return True
+        if until <= self.clock():
+            del self.unavailable[method_name]
+            return True
+        return False
+
+    def send(self, channel, text, image_url, context):
+        """ Queues a message and returns at once """
+        self.stats.setdefault(channel, ChannelStats()).queued += 1
+        message = {'text': text, 'image_url': image_url, 'context': context, 'attempts': 0, 'delivered': False}
+        if channel in self.pending:
+            self.pending[channel].append(message)
+            return
+        self.pending[channel] = [message]
+        self.spawn(self._run, channel)
+
+    def _deliver(self, channel, messages):
+        if len(messages) > 1 and self.supports('send_images_to_slack'):
+            try:
+                self.notifier.send_images_to_slack(
+                    channel, [dict((k, m[k]) for k in ('text', 'image_url', 'context')) for m in messages])
+                for m in messages:
+                    m['delivered'] = True
+                return
+            except MethodNotFound:
+                self.unavailable['send_images_to_slack'] = self.clock() + self.unavailable_ttl
+                _log.warning('Notifier does not provide send_images_to_slack, sending messages one by one')
+        for m in messages:
+            self.notifier.send_to_slack(channel, m['text'], image_url=m['image_url'], context=m['context'])
+            m['delivered'] = True
+
+    def _run(self, channel):
+        stats = self.stats[channel]
+        while self.pending.get(channel):
+            self.sleep(self.window)
+            interval = self.intervals.get(channel, self.min_interval)
+            elapsed = self.clock() - self.last_sent.get(channel, float('-inf'))
+            if elapsed < interval:
+                self.sleep(interval - elapsed)
+            messages = self.pending[channel][:self.max_batch]
+            del self.pending[channel][:self.max_batch]
+            self.last_sent[channel] = self.clock()
+            try:
+                with self.sending:
+                    self._deliver(channel, messages)
+            except Exception as exc:
+                stats.failures += 1
+                self.intervals[channel] = min(interval * 2, self.max_interval)
+                undelivered = [m for m in messages if not m['delivered']]
+                retried = [m for m in undelivered if m['attempts'] < self.retries]
+                for m in retried:
+                    m['attempts'] += 1
+                stats.messages += len(messages) - len(undelivered)
+                stats.dropped += len(undelivered) - len(retried)
+                self.pending[channel][:0] = retried
+                _log.error('Notification of {} messages to {} failed: {}'.format(len(undelivered), channel, str(exc)))
+                continue
+            self.intervals.pop(channel, None)
+            stats.messages += len(messages)
+            stats.batches += 1
+        self.pending.pop(channel, None)
+
+    def summary(self):
+        return dict((channel, stats.to_dict()) for channel, stats in self.stats.items())
+
+
+class NotificationDispatcher(DependencyProvider):
+    """ Provides the Dispatcher configured under NOTIFICATIONS (window, min_interval, max_interval, max_batch, retries,
+    timeout).
+
+    Batches are flushed after the worker that queued them has returned, so the dispatcher calls the target service
+    through its own cluster proxy, started and stopped with the container, rather than a worker's RpcProxy.
+    Messages still queued when the container stops are lost.
+    """
+
+    def __init__(self, target_service='notifier'):
+        self.target_service = target_service
+        self.rpc = None
+        self.dispatcher = None
+
+    def setup(self):
+        config = self.container.config.get('NOTIFICATIONS') or {}
+        self.timeout = config.get('timeout', 30.)
+        self.dispatcher = Dispatcher(self.container.spawn_managed_thread,
+                                     window=config.get('window', 2.),
+                                     min_interval=config.get('min_interval', 1.),
+                                     max_interval=config.get('max_interval', 60.),
+                                     max_batch=config.get('max_batch', 10),
+                                     retries=config.get('retries', 2),
+                                     unavailable_ttl=self.container.config.get('RPC_UNAVAILABLE_TTL', 300))
+
+    def start(self):
+        self.rpc = ClusterRpcProxy(self.container.config, timeout=self.timeout)
+        self.dispatcher.notifier = self.rpc.start()[self.target_service]
+
+    def stop(self):
+        if self.rpc is not None:
+            self.rpc.stop()
+            self.rpc = None
+
+    def get_dependency(self, worker_ctx):
+        return self.dispatcher
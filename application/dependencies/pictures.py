@@ -0,0 +1,80 @@
+import hashlib
+import os
+import tempfile
+from logging import getLogger
+
+from eventlet import tpool
+from nameko.extensions import DependencyProvider
+
+_log = getLogger(__name__)
+
+REFERENCE_PREFIX = 'ref://sha256/'
+
+
+class PictureStoreError(Exception):
+    pass
+
+
+class PictureStore(object):
+    """ Content addressed store of pictures on a directory shared with downstream services.
+
+    Pictures are written once under their SHA-256 and replaced in payloads by a reference
+    that downstream services resolve with ``get``. A picture removed from the directory is
+    written again the next time it is put.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    @staticmethod
+    def is_reference(value):
+        return isinstance(value, str) and value.startswith(REFERENCE_PREFIX)
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, picture):
+        content = picture.encode('utf-8') if isinstance(picture, str) else picture
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        return REFERENCE_PREFIX + digest
+
+    def put_all(self, pictures):
+        """ Puts pictures from a native thread, hashing and writing them off the hub, and returns their references """
+        return tpool.execute(lambda: [self.put(picture) for picture in pictures])
+
+    def get(self, reference):
+        if not self.is_reference(reference):
+            raise PictureStoreError('Not a picture reference: {}'.format(reference))
+        path = self._path(reference[len(REFERENCE_PREFIX):])
+        if not os.path.exists(path):
+            raise PictureStoreError('Picture not found in store: {}'.format(reference))
+        with open(path, 'rb') as f:
+            return f.read().decode('utf-8')
+
+    def dereference(self, results):
+        for entry in results.get('referential', {}).values():
+            for _format, picture in (entry.get('picture') or {}).items():
+                if self.is_reference(picture):
+                    entry['picture'][_format] = self.get(picture)
+        return results
+
+
+class SharedPictureStore(DependencyProvider):
+    """ Provides a PictureStore when PICTURE_STORE_PATH is configured, None otherwise """
+
+    def setup(self):
+        self.store = None
+        root = self.container.config.get('PICTURE_STORE_PATH')
+        if root:
+            _log.info('Pictures will be passed by reference through {}'.format(root))
+            self.store = PictureStore(root)
+
+    def get_dependency(self, worker_ctx):
+        return self.store
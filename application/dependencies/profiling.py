@@ -0,0 +1,194 @@
+import cProfile
+import os
+import pstats
+import signal
+import time
+from collections import Counter
+from logging import getLogger
+
+import eventlet
+import greenlet
+from nameko.extensions import DependencyProvider
+
+_log = getLogger(__name__)
+
+
+class ProfilingError(Exception):
+    pass
+
+
+class SamplingSession(object):
+    """ Samples the stack running on the hub every interval seconds of CPU time, written as folded stacks """
+
+    extension = 'folded'
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = Counter()
+        self.previous_handler = None
+
+    def _sample(self, signum, frame):
+        stack = list()
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.previous_handler or signal.SIG_DFL)
+
+    def enter(self):
+        pass
+
+    def exit(self):
+        pass
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+
+class DeterministicSession(object):
+    """ Profiles with cProfile the workers entered during the session, written as pstats.
+
+    Each worker has its own profile, enabled only while its green thread runs, so that the calls of the other
+    green threads switched to meanwhile are left out. Green threads spawned by a worker are not profiled.
+    """
+
+    extension = 'pstats'
+
+    def __init__(self, interval):
+        self.profiles = dict()
+        self.stats = None
+        self.previous_trace = None
+
+    def _switch(self, event, args):
+        if event in ('switch', 'throw'):
+            origin, target = args
+            if origin in self.profiles:
+                self.profiles[origin].disable()
+            if target in self.profiles:
+                self.profiles[target].enable()
+        if self.previous_trace is not None:
+            self.previous_trace(event, args)
+
+    def _collect(self, profile):
+        profile.disable()
+        if self.stats is None:
+            self.stats = pstats.Stats(profile)
+        else:
+            self.stats.add(profile)
+
+    def start(self):
+        self.previous_trace = greenlet.settrace(self._switch)
+
+    def stop(self):
+        greenlet.settrace(self.previous_trace)
+        for profile in self.profiles.values():
+            self._collect(profile)
+        self.profiles.clear()
+
+    def enter(self):
+        profile = cProfile.Profile()
+        self.profiles[greenlet.getcurrent()] = profile
+        profile.enable()
+
+    def exit(self):
+        profile = self.profiles.pop(greenlet.getcurrent(), None)
+        if profile is not None:
+            self._collect(profile)
+
+    def dump(self, path):
+        (self.stats or pstats.Stats(cProfile.Profile())).dump_stats(path)
+
+
+SESSIONS = {
+    'sampling': SamplingSession,
+    'deterministic': DeterministicSession
+}
+
+
+class Profiler(object):
+    """ Runs one time boxed profiling session at a time, nothing is installed between sessions.
+
+    Workers call enter and exit from their green thread so that a deterministic session profiles them.
+    """
+
+    def __init__(self, spawn, directory, max_seconds=300):
+        self.spawn = spawn
+        self.directory = directory
+        self.max_seconds = max_seconds
+        self.session = None
+        self.until = None
+
+    def start(self, seconds, mode='sampling', interval=0.005):
+        if mode not in SESSIONS:
+            raise ProfilingError('Unknown profiling mode: {} (expected one of {})'.format(mode, ', '.join(SESSIONS)))
+        if self.session is not None:
+            raise ProfilingError('A profiling session is already running for {:.0f}s'.format(
+                self.until - time.monotonic()))
+        seconds = min(seconds, self.max_seconds)
+        os.makedirs(self.directory, exist_ok=True)
+        session = SESSIONS[mode](interval)
+        path = os.path.join(self.directory, 'template-{}-{}.{}'.format(
+            mode, time.strftime('%Y%m%d-%H%M%S'), session.extension))
+        session.start()
+        self.session = session
+        self.until = time.monotonic() + seconds
+        self.spawn(self._stop_after, session, seconds, path)
+        _log.info('Profiling ({}) for {}s into {}'.format(mode, seconds, path))
+        return {'mode': mode, 'seconds': seconds, 'path': path}
+
+    def _stop_after(self, session, seconds, path):
+        try:
+            eventlet.sleep(seconds)
+        finally:
+            session.stop()
+            self.session = None
+            session.dump(path)
+            _log.info('Profile written into {}'.format(path))
+
+    def enter(self):
+        if self.session is not None:
+            self.session.enter()
+
+    def exit(self):
+        if self.session is not None:
+            self.session.exit()
+
+    def status(self):
+        if self.session is None:
+            return None
+        return {'remaining_seconds': max(0., self.until - time.monotonic())}
+
+
+class OnDemandProfiler(DependencyProvider):
+    """ Provides the Profiler writing into PROFILING.path, sessions last at most PROFILING.max_seconds.
+
+    Deterministic sessions profile the workers of the PROFILING.entrypoints.
+    """
+
+    def setup(self):
+        config = self.container.config.get('PROFILING') or {}
+        self.profiler = Profiler(self.container.spawn_managed_thread,
+                                 config.get('path') or '/tmp/template-profiles',
+                                 config.get('max_seconds', 300))
+        self.entrypoints = set(config.get('entrypoints') or ['resolve'])
+
+    def worker_setup(self, worker_ctx):
+        if worker_ctx.entrypoint.method_name in self.entrypoints:
+            self.profiler.enter()
+
+    def worker_teardown(self, worker_ctx):
+        if worker_ctx.entrypoint.method_name in self.entrypoints:
+            self.profiler.exit()
+
+    def get_dependency(self, worker_ctx):
+        return self.profiler
@@ -0,0 +1,208 @@
+import time
+from collections import deque
+from logging import getLogger
+
+import eventlet
+from eventlet.queue import Queue, Empty
+from nameko.exceptions import MethodNotFound
+from nameko.rpc import RpcProxy
+
+_log = getLogger(__name__)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CallStats(object):
+
+    def __init__(self, window):
+        self.latencies = deque(maxlen=window)
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def percentile(self, pct):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        index = int(round(pct / 100. * (len(ordered) - 1)))
+        return ordered[min(index, len(ordered) - 1)]
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'hedged': self.hedged,
+            'hedge_wins': self.hedge_wins,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99)
+        }
+
+
+def _wait_reply(reply, hedge, replies):
+    try:
+        replies.put((hedge, True, reply.result()))
+    except Exception as exc:
+        replies.put((hedge, False, exc))
+
+
+class CallPolicy(object):
+    """ Applies per-method deadlines and hedging to the calls made to one downstream service.
+
+    A hedge is a duplicate of a call still pending after the configured latency percentile
+    of that method, the first successful reply wins. The call only fails once every request
+    it sent failed. Only idempotent services should be hedged.
+
+    Methods the downstream service replied it does not provide are remembered as unavailable for
+    unavailable_ttl seconds, after which they are tried again.
+    """
+
+    def __init__(self, service_name, deadlines=None, hedged=False, percentile=95, min_samples=20, window=200,
+                 unavailable_ttl=300, clock=time.monotonic):
+        self.service_name = service_name
+        self.deadlines = deadlines or {}
+        self.hedged = hedged
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self.unavailable_ttl = unavailable_ttl
+        self.clock = clock
+        self.stats = dict()
+        self.unavailable = dict()
+
+    def _get_stats(self, method_name):
+        if method_name not in self.stats:
+            self.stats[method_name] = CallStats(self.window)
+        return self.stats[method_name]
+
+    def available(self, method_name):
+        until = self.unavailable.get(method_name)
+        if until is None:
+            return True
+        if until <= self.clock():
+            del self.unavailable[method_name]
+            return True
+        return False
+
+    def deadline(self, method_name):
+        return self.deadlines.get(method_name, self.deadlines.get('default'))
+
+    def hedge_delay(self, method_name):
+        if not self.hedged:
+            return None
+        stats = self._get_stats(method_name)
+        if len(stats.latencies) < self.min_samples:
+            return None
+        return stats.percentile(self.percentile)
+
+    def call(self, method_name, method, *args, **kwargs):
+        stats = self._get_stats(method_name)
+        stats.calls += 1
+        deadline = self.deadline(method_name)
+        delay = self.hedge_delay(method_name)
+        replies = Queue()
+        started = time.monotonic()
+        waiters = [eventlet.spawn(_wait_reply, method.call_async(*args, **kwargs), False, replies)]
+        try:
+            with eventlet.Timeout(deadline, DeadlineExceeded('{}.{} did not reply within {}s'.format(
+                    self.service_name, method_name, deadline))):
+                try:
+                    hedge, ok, value = replies.get(timeout=delay)
+                except Empty:
+                    _log.debug('Hedging {}.{} after {:.3f}s'.format(self.service_name, method_name, delay))
+                    stats.hedged += 1
+                    waiters.append(eventlet.spawn(
+                        _wait_reply, method.call_async(*args, **kwargs), True, replies))
+                    hedge, ok, value = replies.get()
+                pending = len(waiters) - 1
+                failure = None
+                while not ok and pending:
+                    failure = failure or value
+                    hedge, ok, value = replies.get()
+                    pending -= 1
+                if not ok and failure is not None:
+                    value = failure
+        except DeadlineExceeded as exc:
+            stats.timeouts += 1
+            _log.warning(str(exc))
+            raise
+        finally:
+            for w in waiters:
+                w.kill()
+
+        if hedge and ok:
+            stats.hedge_wins += 1
+        if not ok:
+            stats.errors += 1
+            if isinstance(value, MethodNotFound):
+                self.unavailable[method_name] = self.clock() + self.unavailable_ttl
+            raise value
+        stats.latencies.append(time.monotonic() - started)
+        return value
+
+    def summary(self):
+        return dict((k, v.to_dict()) for k, v in self.stats.items())
+
+
+class ResilientMethodProxy(object):
+
+    def __init__(self, method_name, method, policy):
+        self.method_name = method_name
+        self.method = method
+        self.policy = policy
+
+    def __call__(self, *args, **kwargs):
+        return self.policy.call(self.method_name, self.method, *args, **kwargs)
+
+    def call_async(self, *args, **kwargs):
+        return self.method.call_async(*args, **kwargs)
+
+
+class ResilientServiceProxy(object):
+
+    def __init__(self, proxy, policy):
+        self.proxy = proxy
+        self.policy = policy
+
+    def __getattr__(self, name):
+        return ResilientMethodProxy(name, getattr(self.proxy, name), self.policy)
+
+    def supports(self, method_name):
+        """ Returns False while the downstream service is remembered as not providing the method """
+        return self.policy.available(method_name)
+
+
+class ResilientRpcProxy(RpcProxy):
+    """ RpcProxy enforcing the deadlines and hedging configured under RPC_DEADLINES and RPC_HEDGING.
+
+    RPC_DEADLINES holds a global ``default`` and per-service mappings of method name (or ``default``)
+    to seconds, RPC_HEDGING holds ``enabled``, ``percentile``, ``min_samples`` and ``window``.
+    Methods a service does not provide are tried again after RPC_UNAVAILABLE_TTL seconds.
+    """
+
+    def __init__(self, target_service, hedged=False, **options):
+        super(ResilientRpcProxy, self).__init__(target_service, **options)
+        self.hedged = hedged
+        self.policy = None
+
+    def setup(self):
+        config = self.container.config
+        all_deadlines = config.get('RPC_DEADLINES') or {}
+        deadlines = dict(all_deadlines.get(self.target_service) or {})
+        if 'default' not in deadlines and 'default' in all_deadlines:
+            deadlines['default'] = all_deadlines['default']
+        hedging = config.get('RPC_HEDGING') or {}
+        self.policy = CallPolicy(self.target_service, deadlines,
+                                 hedged=self.hedged and hedging.get('enabled', False),
+                                 percentile=hedging.get('percentile', 95),
+                                 min_samples=hedging.get('min_samples', 20),
+                                 window=hedging.get('window', 200),
+                                 unavailable_ttl=config.get('RPC_UNAVAILABLE_TTL', 300))
+
+    def get_dependency(self, worker_ctx):
+        return ResilientServiceProxy(super(ResilientRpcProxy, self).get_dependency(worker_ctx), self.policy)
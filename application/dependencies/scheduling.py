@@ -0,0 +1,71 @@
+from collections import OrderedDict, deque
+from logging import getLogger
+
+from nameko.extensions import DependencyProvider
+
+_log = getLogger(__name__)
+
+
+class FairQueue(object):
+    """ Queues items per key and pops them by weighted round robin over the keys, each turn taking up to weight
+    items of a key.
+
+    Keys take turns in the order they were first queued and the items of a key keep their order.
+    """
+
+    def __init__(self, weights=None, default_weight=1):
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        self.queues = OrderedDict()
+        self.taken = 0
+        self.consumers = 0
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def put(self, key, item):
+        self.queues.setdefault(key, deque()).append(item)
+
+    def pop(self):
+        """ Returns the next item, None when the queue is empty """
+        while self.queues:
+            key, queue = next(iter(self.queues.items()))
+            if queue and self.taken < max(1, int(self.weights.get(key, self.default_weight))):
+                self.taken += 1
+                return queue.popleft()
+            self.taken = 0
+            del self.queues[key]
+            if queue:
+                self.queues[key] = queue
+        return None
+
+    def drain(self):
+        """ Yields the items until the queue is empty, counted as a consumer meanwhile """
+        self.consumers += 1
+        try:
+            while True:
+                item = self.pop()
+                if item is None:
+                    return
+                yield item
+        finally:
+            self.consumers -= 1
+
+
+class SharedTriggerQueue(DependencyProvider):
+    """ Provides the FairQueue of fired triggers shared by all the workers of the container.
+
+    Triggers are queued per user, weighted under TRIGGER_SCHEDULING (default_weight, weights). Triggers still
+    queued when the container stops are lost.
+    """
+
+    def setup(self):
+        config = self.container.config.get('TRIGGER_SCHEDULING') or {}
+        self.queue = FairQueue(config.get('weights'), config.get('default_weight', 1))
+
+    def stop(self):
+        if len(self.queue):
+            _log.warning('{} queued triggers dropped at stop'.format(len(self.queue)))
+
+    def get_dependency(self, worker_ctx):
+        return self.queue
@@ -0,0 +1,256 @@
+import datetime
+import json
+import os
+import pickle
+import struct
+import sys
+import time
+from logging import getLogger
+
+import bson.json_util
+from eventlet.green import subprocess
+from eventlet.queue import LightQueue
+from nameko.extensions import DependencyProvider
+
+_log = getLogger(__name__)
+
+HEADER = struct.Struct('>Q')
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class DateEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.date)):
+            return o.isoformat()
+        return json.JSONEncoder.default(self, o)
+
+
+def _json_key(key):
+    if isinstance(key, str):
+        return key
+    if key is None or isinstance(key, bool):
+        return json.dumps(key)
+    return repr(key) if isinstance(key, float) else str(key)
+
+
+def _with_str_keys(obj):
+    if isinstance(obj, dict):
+        return dict((_json_key(k), _with_str_keys(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [_with_str_keys(v) for v in obj]
+    return obj
+
+
+def canonical_dumps(obj, **kwargs):
+    """ Dumps obj with sorted keys, keys of mixed types being sorted as the strings JSON writes them as """
+    try:
+        return json.dumps(obj, cls=DateEncoder, sort_keys=True, **kwargs)
+    except TypeError:
+        return json.dumps(_with_str_keys(obj), cls=DateEncoder, sort_keys=True, **kwargs)
+
+
+OPERATIONS = {
+    'dumps': lambda obj: json.dumps(obj, cls=DateEncoder),
+    'dumps_canonical': lambda obj: canonical_dumps(obj, separators=(',', ':')),
+    'loads': json.loads,
+    'loads_bson': bson.json_util.loads
+}
+
+
+class SerializationError(Exception):
+    pass
+
+
+def _read_frame(stream):
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    size = HEADER.unpack(header)[0]
+    chunks = list()
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk:
+            raise SerializationError('Serialization worker stream closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return pickle.loads(b''.join(chunks))
+
+
+def _write_frame(stream, obj):
+    _write_data(stream, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def _write_data(stream, data):
+    stream.write(HEADER.pack(len(data)))
+    stream.write(data)
+    stream.flush()
+
+
+class ProcessPool(object):
+    """ Pool of serialization worker processes talking pickled frames over their standard streams.
+
+    A worker failing to exchange a frame is killed and replaced, the call raises SerializationError.
+    """
+
+    def __init__(self, processes):
+        self.workers = LightQueue()
+        self.processes = list()
+        for _ in range(processes):
+            self._spawn()
+
+    def _spawn(self):
+        process = subprocess.Popen([sys.executable, '-m', __name__], cwd=ROOT_PATH,
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.processes.append(process)
+        self.workers.put(process)
+
+    def _replace(self, process):
+        self.processes.remove(process)
+        try:
+            process.kill()
+            process.wait()
+        except OSError:
+            pass
+        try:
+            self._spawn()
+        except OSError as exc:
+            _log.error('Serialization worker not replaced: {}'.format(str(exc)))
+
+    def execute(self, operation, payload):
+        if not self.processes:
+            raise SerializationError('No serialization worker left')
+        try:
+            data = pickle.dumps((operation, payload), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as exc:
+            raise SerializationError('Payload can not be sent to a serialization worker: {}'.format(str(exc)))
+        process = self.workers.get()
+        try:
+            # a green write to a pipe nobody reads never wakes up, check the worker is alive first
+            if process.poll() is not None:
+                raise SerializationError('Serialization worker exited')
+            _write_data(process.stdin, data)
+            reply = _read_frame(process.stdout)
+            if reply is None:
+                raise SerializationError('Serialization worker exited')
+        except Exception as exc:
+            self._replace(process)
+            if isinstance(exc, SerializationError):
+                raise
+            raise SerializationError('Serialization worker failed: {!r}'.format(exc))
+        self.workers.put(process)
+        ok, result = reply
+        if not ok:
+            raise SerializationError(result)
+        return result
+
+    def close(self):
+        for process in self.processes:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+            process.wait()
+
+
+class OperationStats(object):
+
+    def __init__(self):
+        self.inline = 0
+        self.inline_seconds = 0.
+        self.max_inline_seconds = 0.
+        self.offloaded = 0
+        self.offloaded_seconds = 0.
+
+    def to_dict(self):
+        return {
+            'inline': self.inline,
+            'hub_blocking_seconds': self.inline_seconds,
+            'max_hub_blocking_seconds': self.max_inline_seconds,
+            'offloaded': self.offloaded,
+            'offloaded_seconds': self.offloaded_seconds
+        }
+
+
+class Serializer(object):
+    """ Runs JSON and BSON (de)serialization inline, or in the process pool above threshold characters.
+
+    Inline runs block the eventlet hub, their duration is accounted as hub blocking time.
+    """
+
+    def __init__(self, pool=None, threshold=1048576):
+        self.pool = pool
+        self.threshold = threshold
+        self.stats = dict((operation, OperationStats()) for operation in OPERATIONS)
+
+    def _execute(self, operation, payload, size):
+        stats = self.stats[operation]
+        started = time.perf_counter()
+        if self.pool is not None and size >= self.threshold:
+            try:
+                result = self.pool.execute(operation, payload)
+                stats.offloaded += 1
+                stats.offloaded_seconds += time.perf_counter() - started
+                return result
+            except SerializationError as exc:
+                _log.error('Serialization offloading failed, running {} inline: {}'.format(operation, str(exc)))
+                started = time.perf_counter()
+        result = OPERATIONS[operation](payload)
+        elapsed = time.perf_counter() - started
+        stats.inline += 1
+        stats.inline_seconds += elapsed
+        stats.max_inline_seconds = max(stats.max_inline_seconds, elapsed)
+        return result
+
+    def dumps(self, obj, size_hint=0, canonical=False):
+        """ Canonical JSON has sorted keys and no whitespace, equal objects get identical texts """
+        return self._execute('dumps_canonical' if canonical else 'dumps', obj, size_hint)
+
+    def loads(self, text):
+        return self._execute('loads', text, len(text))
+
+    def loads_bson(self, text):
+        return self._execute('loads_bson', text, len(text))
+
+    def summary(self):
+        return dict((operation, stats.to_dict()) for operation, stats in self.stats.items())
+
+
+class OffloadedSerialization(DependencyProvider):
+    """ Provides the Serializer configured under SERIALIZATION (processes, threshold) """
+
+    def setup(self):
+        self.config = self.container.config.get('SERIALIZATION') or {}
+        self.pool = None
+        self.serializer = Serializer(threshold=self.config.get('threshold', 1048576))
+
+    def start(self):
+        processes = self.config.get('processes', 0)
+        if processes > 0:
+            self.pool = ProcessPool(processes)
+            self.serializer.pool = self.pool
+
+    def stop(self):
+        if self.pool is not None:
+            self.serializer.pool = None
+            self.pool.close()
+
+    def get_dependency(self, worker_ctx):
+        return self.serializer
+
+
+def main():
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    while True:
+        request = _read_frame(stdin)
+        if request is None:
+            return
+        operation, payload = request
+        try:
+            reply = (True, OPERATIONS[operation](payload))
+        except Exception as exc:
+            reply = (False, repr(exc))
+        _write_frame(stdout, reply)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+COLUMNAR = 'columnar'
+
+
+def to_columnar(rows):
+    """ Turns a list of row dicts into {'columns': [...], 'rows': [[...]]}, missing values become None """
+    columns = list()
+    known = set()
+    for row in rows:
+        for column in row:
+            if column not in known:
+                known.add(column)
+                columns.append(column)
+    return {'columns': columns, 'rows': [[row.get(column) for column in columns] for row in rows]}
+
+
+def to_records(results):
+    """ Turns a columnar query result back into a list of row dicts, any other result is returned as is """
+    if not isinstance(results, dict) or 'columns' not in results or 'rows' not in results:
+        return results
+    columns = results['columns']
+    return [dict(zip(columns, row)) for row in results['rows']]
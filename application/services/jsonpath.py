@@ -0,0 +1,124 @@
+import re
+from functools import lru_cache
+
+JSONPATH_PATTERN = re.compile(r'\$(?:\.\.?(?:[\w-]+|\*)|\[[^\]]*\])+')
+STEP_PATTERN = re.compile(r'\.\.|\.([\w-]+|\*)|\[([^\]]*)\]')
+CONTINUATION_PATTERN = re.compile(r'[\w-]')
+
+ANY_KEY = '*'
+ANY_INDEX = '[]'
+
+
+def _parse_steps(expression):
+    steps = list()
+    position = 1
+    while position < len(expression):
+        match = STEP_PATTERN.match(expression, position)
+        if match is None or match.group(0) == '..':
+            return None
+        name, subscript = match.groups()
+        if name is not None:
+            steps.append(name)
+        else:
+            subscript = subscript.strip()
+            if subscript.startswith('?') or '(' in subscript:
+                return None
+            if subscript == '*':
+                steps.append(ANY_KEY)
+            elif re.match(r'^-?\d*(:-?\d*){0,2}$|^\d+(,\s*\d+)*$', subscript):
+                steps.append(ANY_INDEX)
+            elif subscript[:1] in ('"', "'") and subscript[-1:] == subscript[:1]:
+                steps.append(subscript[1:-1])
+            else:
+                return None
+        position = match.end()
+    return steps
+
+
+def _merge(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left is True or right is True:
+        return True
+    merged = dict(left)
+    for k, v in right.items():
+        merged[k] = _merge(merged.get(k), v)
+    return merged
+
+
+class JsonPathSelection(object):
+    """ Tree of the keys reachable from a set of jsonpath expressions.
+
+    Lists are never shortened so that indexes in the expressions remain valid, only the keys
+    of their items are pruned.
+    """
+
+    def __init__(self, expressions):
+        self.expressions = expressions
+        self.tree = dict()
+        for steps in expressions:
+            node = True
+            for step in reversed(steps):
+                node = {step: node}
+            self.tree = _merge(self.tree, node)
+
+    @staticmethod
+    def _child(node, step):
+        if node is True:
+            return True
+        return _merge(node.get(step), node.get(ANY_KEY))
+
+    def reaches(self, path):
+        node = self.tree
+        for step in path:
+            node = self._child(node, step)
+            if node is None:
+                return False
+        return True
+
+    def prune(self, data, node=None):
+        node = self.tree if node is None else node
+        if node is True:
+            return data
+        if isinstance(data, dict):
+            pruned = dict()
+            for k, v in data.items():
+                child = self._child(node, k)
+                if child is not None:
+                    pruned[k] = self.prune(v, child)
+            return pruned
+        if isinstance(data, list):
+            child = self._child(node, ANY_INDEX)
+            if child is None:
+                return data
+            return [self.prune(item, child) for item in data]
+        return data
+
+
+def extract_jsonpaths(svg):
+    """ Returns the jsonpath expressions of an SVG template, None when one of them could not be read entirely """
+    expressions = set()
+    for m in JSONPATH_PATTERN.finditer(svg):
+        if CONTINUATION_PATTERN.match(svg, m.end()):
+            return None
+        expressions.add(m.group(0))
+    return sorted(expressions)
+
+
+@lru_cache(maxsize=256)
+def selection_for_svg(svg):
+    """ Returns the selection of the data used by an SVG template or None if it can not be restricted """
+    found = extract_jsonpaths(svg)
+    if found is None:
+        return None
+    expressions = list()
+    for expression in found:
+        steps = _parse_steps(expression)
+        if steps is None:
+            return None
+        expressions.append(steps)
+    if not expressions:
+        return None
+    return JsonPathSelection(expressions)
@@ -0,0 +1,72 @@
+import time
+from logging import getLogger
+
+import eventlet
+from eventlet.queue import Queue
+
+_log = getLogger(__name__)
+
+_DONE = object()
+
+
+class Stage(object):
+
+    def __init__(self, name, fn, stats, concurrency=1, maxsize=1):
+        self.name = name
+        self.fn = fn
+        self.stats = stats
+        self.concurrency = max(1, concurrency)
+        self.maxsize = max(1, maxsize)
+
+
+class Pipeline(object):
+    """ Runs items through stages connected by bounded queues, each stage having its own green workers.
+
+    A stage returns the item handed to the next stage, or None to drop it. Putting into a full queue blocks
+    the previous stage, so a slow stage holds the items back instead of letting them pile up. A failing
+    item is logged and dropped without stopping the others.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.queues = [Queue(stage.maxsize) for stage in stages]
+
+    def _put(self, index, item):
+        self.queues[index].put(item)
+        self.stages[index].stats.enqueued()
+
+    def _work(self, index):
+        stage = self.stages[index]
+        while True:
+            item = self.queues[index].get()
+            if item is _DONE:
+                return
+            stage.stats.dequeued()
+            started = time.perf_counter()
+            try:
+                result = stage.fn(item)
+            except Exception as exc:
+                stage.stats.done(time.perf_counter() - started, failed=True)
+                _log.error('Stage {} failed: {}'.format(stage.name, str(exc)))
+                continue
+            stage.stats.done(time.perf_counter() - started)
+            if result is not None and index + 1 < len(self.stages):
+                self._put(index + 1, result)
+
+    def run(self, items):
+        started = time.perf_counter()
+        pools = list()
+        for index, stage in enumerate(self.stages):
+            pool = eventlet.GreenPool(stage.concurrency)
+            for _ in range(stage.concurrency):
+                pool.spawn(self._work, index)
+            pools.append(pool)
+        for item in items:
+            self._put(0, item)
+        for index, stage in enumerate(self.stages):
+            for _ in range(stage.concurrency):
+                self.queues[index].put(_DONE)
+            pools[index].waitall()
+        elapsed = time.perf_counter() - started
+        for stage in self.stages:
+            stage.stats.active_seconds += elapsed
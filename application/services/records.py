@@ -0,0 +1,16 @@
+class ReferentialRecord(object):
+    """ Decoded referential document shared by every request resolving the same version of it.
+
+    The document must not be mutated, the names derived from it are memoized per language.
+    """
+
+    __slots__ = ('document', 'names')
+
+    def __init__(self, document):
+        self.document = document
+        self.names = dict()
+
+    def localized_names(self, language, derive):
+        if language not in self.names:
+            self.names[language] = derive(self.document, language)
+        return self.names[language]
@@ -0,0 +1,13 @@
+from functools import lru_cache
+
+
+@lru_cache(maxsize=1024)
+def infer_sources(sql, table_sources):
+    """ Returns the (source, type) loading the tables read by a query, None when it reads none of them.
+
+    table_sources is a tuple of (table, source, type). Table names are matched as case insensitive substrings
+    of the SQL so that a table is never missed, at worst a query depends on more sources than it reads.
+    """
+    text = sql.lower()
+    sources = set((source, _type) for table, source, _type in table_sources if table.lower() in text)
+    return tuple(sorted(sources)) or None
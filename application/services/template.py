@@ -1,16 +1,43 @@
 import json
-import datetime
+import hashlib
 import os
 import uuid
 from logging import getLogger, basicConfig
-from nameko.rpc import rpc, RpcProxy
+from nameko.rpc import rpc
 from nameko.events import event_handler, BROADCAST
-from nameko.dependency_providers import DependencyProvider
+from nameko.dependency_providers import Config, DependencyProvider
+from nameko.exceptions import MethodNotFound
 import bson.json_util
+import eventlet
+
+from application.dependencies.background import BackgroundTasks
+from application.dependencies.cache import ServiceCache
+from application.dependencies.compression import PayloadCodec
+from application.dependencies.metrics import ServiceMetrics
+from application.dependencies.notifications import NotificationDispatcher
+from application.dependencies.pictures import SharedPictureStore
+from application.dependencies.profiling import OnDemandProfiler
+from application.dependencies.rpc import ResilientRpcProxy
+from application.dependencies.scheduling import SharedTriggerQueue
+from application.dependencies.serialization import DateEncoder, OffloadedSerialization, canonical_dumps
+from application.services.formats import COLUMNAR, to_columnar
+from application.services.jsonpath import selection_for_svg
+from application.services.pipeline import Pipeline, Stage
+from application.services.records import ReferentialRecord
+from application.services.sources import infer_sources
+from application.services.working_set import WorkingSet
 
 _log = getLogger(__name__)
 
 CDN_ROOT_URL = os.getenv('CDN_ROOT_URL')
+UNDECLARED_SOURCE = ('*', '*')
+EMPTY_RESULTS = (None, '', 'null')
+TRIGGER_STAGES = {
+    'resolve': {'concurrency': 4, 'queue_size': 1},
+    'render': {'concurrency': 2, 'queue_size': 4},
+    'export': {'concurrency': 2, 'queue_size': 4},
+    'notify': {'concurrency': 1, 'queue_size': 16}
+}
 
 class ErrorHandler(DependencyProvider):
 
@@ -21,13 +48,6 @@ class ErrorHandler(DependencyProvider):
         _log.error(str(exc))
 
 
-class DateEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, (datetime.datetime, datetime.date)):
-            return o.isoformat()
-        return json.JSONEncoder.default(self, o)
-
-
 class TemplateServiceError(Exception):
     pass
 
@@ -35,13 +55,179 @@ class TemplateServiceError(Exception):
 class TemplateService(object):
     name = 'template'
     error = ErrorHandler()
-    metadata = RpcProxy('metadata')
-    datareader = RpcProxy('datareader')
-    referential = RpcProxy('referential')
-    svg_builder = RpcProxy('svg_builder')
-    subscription = RpcProxy('subscription_manager')
-    exporter = RpcProxy('exporter')
-    notifier = RpcProxy('notifier')
+    metadata = ResilientRpcProxy('metadata', hedged=True)
+    datareader = ResilientRpcProxy('datareader', hedged=True)
+    referential = ResilientRpcProxy('referential', hedged=True)
+    svg_builder = ResilientRpcProxy('svg_builder')
+    subscription = ResilientRpcProxy('subscription_manager')
+    exporter = ResilientRpcProxy('exporter')
+    pictures = SharedPictureStore()
+    codec = PayloadCodec()
+    cache = ServiceCache()
+    tasks = BackgroundTasks()
+    serializer = OffloadedSerialization()
+    metrics = ServiceMetrics()
+    notifications = NotificationDispatcher()
+    profiler = OnDemandProfiler()
+    trigger_queue = SharedTriggerQueue()
+    config = Config()
+
+    downstreams = ('metadata', 'datareader', 'referential',
+                   'svg_builder', 'subscription', 'exporter')
+    working_set = None
+
+    def _memoized(self, key, fn, *args, **kwargs):
+        if self.working_set is None:
+            return fn(*args, **kwargs)
+        return self.working_set.get(key, fn, *args, **kwargs)
+
+    def _memoized_many(self, keys, fn):
+        working_set = self.working_set if self.working_set is not None else WorkingSet()
+        return working_set.get_many(keys, fn)
+
+    def _revalidate(self, region, key, call, tags):
+        cache = self.cache[region]
+        if not cache.start_refresh(key):
+            return
+
+        def refresh():
+            try:
+                generation = cache.generation()
+                value = call()
+                if value not in EMPTY_RESULTS:
+                    cache.set(key, value, tags=tags, generation=generation)
+            finally:
+                cache.end_refresh(key)
+        self.tasks.spawn(f'refresh {region}', refresh)
+
+    def _lookup(self, region, key, call, tags=()):
+        """ Memoizes a downstream call in the request working set and caches its non empty results in a region.
+
+        A stale entry is returned at once while a background task refreshes it. A value whose tags are invalidated
+        while it is being fetched is returned but not cached.
+        """
+        def cached_call():
+            value, stale = self.cache[region].get_entry(key)
+            if value is None:
+                generation = self.cache[region].generation()
+                value = call()
+                if value not in EMPTY_RESULTS:
+                    self.cache[region].set(key, value, tags=tags, generation=generation)
+            elif stale:
+                self._revalidate(region, key, call, tags)
+            return value
+        return self._memoized(key, cached_call)
+
+    def _get_entity(self, entity_id, user):
+        return self._lookup('entities', ('entity', entity_id, user),
+                            lambda: self.referential.get_entity_by_id(entity_id, user))
+
+    def _get_event(self, event_id, user):
+        return self._lookup('events', ('event', event_id, user),
+                            lambda: self.referential.get_event_by_id(event_id, user), tags=[('event', event_id)])
+
+    def _get_entity_picture(self, entity_id, context, _format, user, kind):
+        return self._lookup('pictures', ('picture', entity_id, context, _format, user, kind),
+                            lambda: self.referential.get_entity_picture(entity_id, context, _format, user, kind))
+
+    def _get_label(self, label_id, language, context):
+        return self._lookup('labels', ('label', label_id, language, context),
+                            lambda: self.referential.get_labels_by_id_and_language_and_context(label_id, language, context))
+
+    def _get_query(self, query_id):
+        return self._lookup('queries', ('query', query_id), lambda: self.metadata.get_query(query_id))
+
+    def _load_template(self, template_id, user):
+        return self._lookup('templates', ('template', template_id, user),
+                            lambda: self.metadata.get_template(template_id, user))
+
+    def _get_query_sources(self, current_query):
+        """ Returns the (source, type) declared by a query, or inferred from the tables of QUERY_SOURCES it reads """
+        if current_query.get('sources'):
+            return [(src['source'], src['type']) for src in current_query['sources']]
+        table_sources = tuple(sorted((table, v['source'], v['type'])
+                                     for table, v in (self.config.get('QUERY_SOURCES') or {}).items()))
+        inferred = infer_sources(current_query.get('sql') or '', table_sources) if table_sources else None
+        return list(inferred) if inferred else [UNDECLARED_SOURCE]
+
+    @staticmethod
+    def _get_select_key(query_id, current_query, parameters, limit):
+        sql_hash = hashlib.sha1(current_query['sql'].encode('utf-8')).hexdigest()
+        return 'select', query_id, sql_hash, json.dumps(parameters, cls=DateEncoder), limit
+
+    def _select(self, query_id, current_query, parameters, limit):
+        """ Runs a query through the query results cache.
+
+        Cached results are invalidated by the input_loaded events of the (source, type) declared in the
+        query sources, or by any input_loaded event when the query does not declare its sources.
+        """
+        return self._lookup('query_results', self._get_select_key(query_id, current_query, parameters, limit),
+                            lambda: self.datareader.select(current_query['sql'], parameters, limit=limit),
+                            tags=self._get_query_sources(current_query))
+
+    def _select_many(self, selects):
+        """ Runs in a single datareader call the (query_id, query, parameters, limit) selects missing from the cache.
+
+        The selects are registered in the request working set while in flight, so that concurrent renders wait for
+        them instead of sending them again. Returns the raw results in the order of the selects, None for the selects
+        left to _select: cached or in flight ones, or all of them when there is a single select to run or the
+        datareader does not provide select_many. Raises TemplateServiceError when one of the queries fails.
+        """
+        keys = [self._get_select_key(*select) for select in selects]
+        missing = dict()
+        for key, select in zip(keys, selects):
+            if not self.cache['query_results'].has_entry(key) and \
+                    (self.working_set is None or not self.working_set.knows(key)):
+                missing[key] = select
+        if len(missing) < 2 or not self.datareader.supports('select_many'):
+            return [None] * len(selects)
+
+        def select_missing(missing_keys):
+            batch = [missing[key] for key in missing_keys]
+            self.cache['query_results'].record_misses(len(batch))
+            generation = self.cache['query_results'].generation()
+            replies = None
+            try:
+                replies = self.datareader.select_many([
+                    {'sql': current_query['sql'], 'parameters': parameters, 'limit': limit}
+                    for _, current_query, parameters, limit in batch])
+            except MethodNotFound:
+                _log.warning('Datareader does not provide select_many, running queries one by one')
+            if replies is not None and (not isinstance(replies, list) or len(replies) != len(batch)):
+                _log.warning('Unexpected select_many reply, running queries one by one')
+                replies = None
+            if replies is None:
+                replies = list()
+                for _, current_query, parameters, limit in batch:
+                    try:
+                        replies.append({'results': self.datareader.select(current_query['sql'], parameters,
+                                                                          limit=limit)})
+                    except Exception as exc:
+                        replies.append({'error': str(exc)})
+            raw_results = list()
+            for key, (query_id, current_query, _, _), reply in zip(missing_keys, batch, replies):
+                if reply.get('error') is not None:
+                    _log.warning('Query {} failed in select_many: {}'.format(query_id, reply['error']))
+                    raw_results.append(TemplateServiceError(
+                        'An error occured while executing query {}'.format(query_id)))
+                    continue
+                raw_results.append(reply.get('results'))
+                if raw_results[-1] not in EMPTY_RESULTS:
+                    self.cache['query_results'].set(key, raw_results[-1], tags=self._get_query_sources(current_query),
+                                                    generation=generation)
+            return raw_results
+
+        results = dict(zip(missing, self._memoized_many(list(missing), select_missing)))
+        return [results.get(key) for key in keys]
+
+    def _get_record(self, raw):
+        """ Returns the shared record of a referential document, keyed by the digest of its content """
+        digest = hashlib.sha1(raw.encode('utf-8')).hexdigest()
+        record = self.cache['records'].get(digest)
+        if record is None:
+            record = ReferentialRecord(bson.json_util.loads(raw))
+            self.cache['records'].set(digest, record)
+        return record
 
     @staticmethod
     def _get_overriden_name(entity, language):
@@ -49,15 +235,17 @@ class TemplateService(object):
 
     @staticmethod
     def _get_display_name(entity, language):
-        if TemplateService._get_overriden_name(entity, language):
-            return TemplateService._get_overriden_name(entity, language)
+        overriden_name = TemplateService._get_overriden_name(entity, language)
+        if overriden_name:
+            return overriden_name
 
         return entity['common_name']
 
     @staticmethod
     def _get_short_name(entity, language):
-        if TemplateService._get_overriden_name(entity, language):
-            return TemplateService._get_overriden_name(entity, language)
+        overriden_name = TemplateService._get_overriden_name(entity, language)
+        if overriden_name:
+            return overriden_name
 
         if 'informations' in entity and entity['informations']\
                 and 'last_name' in entity['informations'] and 'known' in entity['informations']:
@@ -76,23 +264,35 @@ class TemplateService(object):
             return {'first_name': entity['informations']['first_name'], 'last_name': entity['informations']['last_name']}
         return {'first_name': '', 'last_name': TemplateService._get_display_name(entity, language)}
 
-    def _append_picture_into_referential_results(self, entry_key, referential_results, json_only, context, _format, kind, user):
+    @staticmethod
+    def _get_names(entity, language):
+        return {
+            'display_name': TemplateService._get_display_name(entity, language),
+            'short_name': TemplateService._get_short_name(entity, language),
+            'multiline_name': TemplateService._get_multiline_name(entity, language)
+        }
+
+    def _append_picture_into_referential_results(self, entry_key, referential_results, json_only, context, _format, kind, user,
+                                                 selection=None):
         entry_id = referential_results[entry_key]['id']
-        if 'picture' not in referential_results[entry_key]:
-            referential_results[entry_key]['picture'] = {}
+        referential_results[entry_key]['picture'] = dict(referential_results[entry_key].get('picture') or {})
 
         if _format not in referential_results[entry_key]['picture']:
             referential_results[entry_key]['picture'][_format] = None
 
+        if selection is not None and not selection.reaches(('referential', entry_key, 'picture', _format)):
+            _log.info('Picture {} of referential entry {} is not used by the template'.format(_format, entry_key))
+            return
+
         if json_only is False:
-            picture = self.referential.get_entity_picture(
+            picture = self._get_entity_picture(
                 entry_id, context, _format, user, kind)
             if not picture:
                 raise TemplateServiceError('Picture not found for referential entry: {} (context: {} / format: {})'.format(
                     entry_id, context, _format))
             referential_results[entry_key]['picture'][_format] = picture
 
-    def _handle_referential(self, referential, language, json_only, user):
+    def _handle_referential(self, referential, records, json_only, user):
         _log.info('Gathering referential entries ...')
         results = dict()
         for k, v in referential.items():
@@ -103,24 +303,46 @@ class TemplateService(object):
                 'Trying to retrieve referential entry {} which has been set under key {}'.format(v['id'], k))
             current_ref_str = None
             if v['event_or_entity'] == 'entity':
-                current_ref_str = self.referential.get_entity_by_id(
+                current_ref_str = self._get_entity(
                     v['id'], user)
             else:
-                current_ref_str = self.referential.get_event_by_id(
+                current_ref_str = self._get_event(
                     v['id'], user)
-            if not current_ref_str:
+            if current_ref_str in EMPTY_RESULTS:
                 raise TemplateServiceError(
                     'Referential entry not found: {}'.format(v['id']))
-            results[k] = bson.json_util.loads(current_ref_str)
-            results[k]['display_name'] = self._get_display_name(
-                results[k], language)
-            results[k]['short_name'] = self._get_short_name(
-                results[k], language)
-            results[k]['multiline_name'] = self._get_multiline_name(
-                results[k], language)
+            records[k] = self._get_record(current_ref_str)
+            results[k] = dict(records[k].document)
         return results
 
-    def _get_query_parameters_and_append_pictures(self, q, current_query, user_parameters, referential_results, json_only, context, user):
+    def _get_trigger_results(self, trigger_id, selects):
+        """ Returns the last raw results of the queries of a trigger when they are still valid, None otherwise.
+
+        Results are kept per (trigger, query) until an input_loaded event of one of the query sources, or until the
+        query runs with other parameters.
+        """
+        if trigger_id is None:
+            return [None] * len(selects)
+        raw_results = list()
+        for select in selects:
+            entry = self.cache['trigger_results'].get(('trigger', trigger_id, select[0]))
+            valid = entry is not None and tuple(entry[0]) == self._get_select_key(*select)
+            raw_results.append(entry[1] if valid else None)
+        _log.info('Reusing the results of {} queries out of {} for trigger {}'.format(
+            len(selects) - raw_results.count(None), len(selects), trigger_id))
+        return raw_results
+
+    def _set_trigger_results(self, trigger_id, select, raw_results, generation):
+        self.cache['trigger_results'].set(('trigger', trigger_id, select[0]),
+                                          (self._get_select_key(*select), raw_results),
+                                          tags=self._get_query_sources(select[1]), generation=generation)
+
+    @staticmethod
+    def _get_referential_parameter_names(q):
+        return set(p['name'] for ref in q.get('referential_parameters') or [] for p in ref.values())
+
+    def _get_query_parameters_and_append_pictures(self, q, current_query, user_parameters, referential_results, json_only, context, user,
+                                                  selection=None):
         current_id = q['id']
         parameters = list()
         if not current_query['parameters']:
@@ -140,101 +362,163 @@ class TemplateService(object):
                     _format = ref[p]['picture']['format']
                     kind = ref[p]['picture'].get('kind', 'bitmap')
                     self._append_picture_into_referential_results(
-                        ref[p]['name'], referential_results, json_only, context, _format, kind, user)
+                        ref[p]['name'], referential_results, json_only, context, _format, kind, user, selection)
         _log.info("Following parameters:{} has been built and will be applied to the query {}".format(
             parameters, current_id))
         return parameters
 
-    def _labelize_row(self, row, q, language, context, user):
-        labelized_row = row.copy()
-        if 'labels' not in q or not q['labels']:
-            return labelized_row
-        current_labels = q['labels']
-        for lab in current_labels:
-            if lab not in row:
-                continue
-            if current_labels[lab] == 'entity':
-                current_entity = bson.json_util.loads(
-                    self.referential.get_entity_by_id(row[lab], user))
-                labelized_row[lab] = current_entity['common_name']
-            elif current_labels[lab] == 'label':
-                current_label = self.referential.get_labels_by_id_and_language_and_context(
-                    row[lab], language, context)
-                if current_label is None:
-                    raise TemplateServiceError(
-                        'Label {} not found'.format(row[lab]))
-                labelized_row[lab] = current_label['label']
-        return labelized_row
+    def _labelize_value(self, value, kind, language, context, user):
+        if kind == 'entity':
+            current_entity = self._get_record(
+                self._get_entity(value, user)).document
+            return current_entity['common_name']
+        current_label = self._get_label(
+            value, language, context)
+        if current_label is None:
+            raise TemplateServiceError(
+                'Label {} not found'.format(value))
+        return current_label['label']
+
+    def _labelize_rows(self, rows, q, language, context, user):
+        """ Labelizes a query result column by column, each distinct value of a labelled column is resolved once.
 
-    def _append_referential_results(self, row, q, referential_results, json_only, context, language, user):
+        Rows without any labelled column are not copied.
+        """
+        if 'labels' not in q or not q['labels']:
+            return list(rows)
+        columns = [(lab, kind) for lab, kind in q['labels'].items() if kind in ('entity', 'label')]
+        mappings = list()
+        for lab, kind in columns:
+            distinct_values = set(row[lab] for row in rows if lab in row)
+            mappings.append((lab, dict((value, self._labelize_value(value, kind, language, context, user))
+                                       for value in distinct_values)))
+        labelized_rows = list()
+        for row in rows:
+            labelized_row = row
+            for lab, mapping in mappings:
+                if lab in row:
+                    if labelized_row is row:
+                        labelized_row = row.copy()
+                    labelized_row[lab] = mapping[row[lab]]
+            labelized_rows.append(labelized_row)
+        return labelized_rows
+
+    def _append_referential_results(self, row, q, referential_results, records, json_only, context, user,
+                                    selection=None):
         current_ref_config = q['referential_results']
         for cfg in current_ref_config:
+            current_column_id = current_ref_config[cfg]['column_id']
             if current_ref_config[cfg]['event_or_entity'] == 'event':
-                current_ref_result = bson.json_util.loads(
-                    self.referential.get_event_by_id(row[cfg], user))
-                if not current_ref_result:
+                current_ref_str = self._get_event(row[cfg], user)
+                if current_ref_str in EMPTY_RESULTS:
                     raise TemplateServiceError(
                         'Event {} not found'.format(row[cfg]))
+                current_record = self._get_record(current_ref_str)
+                records.pop(row[current_column_id], None)
             else:
-                current_ref_result = bson.json_util.loads(
-                    self.referential.get_entity_by_id(row[cfg], user))
-                if not current_ref_result:
+                current_ref_str = self._get_entity(row[cfg], user)
+                if current_ref_str in EMPTY_RESULTS:
                     raise TemplateServiceError(
                         'Entity {} not found'.format(row[cfg]))
-                current_ref_result['display_name'] = self._get_display_name(
-                    current_ref_result, language)
-                current_ref_result['short_name'] = self._get_short_name(
-                    current_ref_result, language)
-                current_ref_result['multiline_name'] = self._get_multiline_name(
-                    current_ref_result, language)
-            current_column_id = current_ref_config[cfg]['column_id']
-            referential_results[row[current_column_id]] = current_ref_result
+                current_record = self._get_record(current_ref_str)
+                records[row[current_column_id]] = current_record
+            referential_results[row[current_column_id]] = dict(current_record.document)
             if 'picture' in current_ref_config[cfg] and json_only is False:
                 self._append_picture_into_referential_results(row[current_column_id], referential_results, json_only, context,
                                                               current_ref_config[cfg]['picture']['format'],
                                                               current_ref_config[cfg]['picture'].get('kind', 'bitmap'),
-                                                              user)
+                                                              user, selection)
 
-    def _get_template_data(self, template, picture_context, language, json_only, referential, user_parameters, user):
+    def _fetch_template_data(self, template, picture_context, json_only, referential, user_parameters, user,
+                             selection=None, trigger_id=None):
+        """ Gathers the language independent data of a template, see _localize_template_data.
+
+        Consecutive queries whose referential parameters are already known are selected together. The parameters
+        of a query are built again, and the query selected alone, when a previous query of the batch changed the
+        referential entries they are built from. The size of the raw query results is kept as a hint of the size
+        of the serialized template data. The queries of a trigger reuse its last results, see _get_trigger_results.
+        """
         _log.info('Building template data ...')
-        context = template['context']
+        size = 0
+        sources = set()
         referential_results = dict()
+        records = dict()
         if referential is not None:
             referential_results = self._handle_referential(
-                referential, language, json_only, user)
+                referential, records, json_only, user)
 
         query_results = dict()
-        for q in template['queries']:
-            query_results[q['id']] = dict()
-            current_query = bson.json_util.loads(
-                self.metadata.get_query(q['id']))
-            current_sql = current_query['sql']
-            current_id = q['id']
-            current_limit = int(q['limit']) if 'limit' in q and isinstance(
-                q['limit'], int) else 50
-            _log.info('Query will be limited to {} rows (a negative value means no limit)'.format(
-                str(current_limit)))
-            parameters = self._get_query_parameters_and_append_pictures(
-                q, current_query, user_parameters, referential_results, json_only, picture_context, user)
-            try:
-                current_results = bson.json_util.loads(self.datareader.select(
-                    current_sql, parameters, limit=current_limit))
-            except:
-                raise TemplateServiceError(
-                    'An error occured while executing query {}'.format(current_id))
-            if not current_results:
-                raise TemplateServiceError(
-                    'Query {} returns nothing'.format(current_id))
-            labelized_results = list()
-            for row in current_results:
-                labelized_results.append(self._labelize_row(
-                    row, q, language, context, user))
+        queries = list(template['queries'])
+        while queries:
+            batch = list()
+            while queries and (not batch or
+                               self._get_referential_parameter_names(queries[0]) <= set(referential_results)):
+                q = queries.pop(0)
+                query_results[q['id']] = dict()
+                current_query = bson.json_util.loads(
+                    self._get_query(q['id']))
+                current_limit = int(q['limit']) if 'limit' in q and isinstance(
+                    q['limit'], int) else 50
+                _log.info('Query will be limited to {} rows (a negative value means no limit)'.format(
+                    str(current_limit)))
+                parameters = self._get_query_parameters_and_append_pictures(
+                    q, current_query, user_parameters, referential_results, json_only, picture_context, user, selection)
+                sources.update(self._get_query_sources(current_query))
+                batch.append((q, current_query, parameters, current_limit))
+            selects = [(q['id'], current_query, parameters, current_limit)
+                       for q, current_query, parameters, current_limit in batch]
+            generation = self.cache['trigger_results'].generation()
+            batch_results = self._get_trigger_results(trigger_id, selects)
+            missing = [i for i, raw_results in enumerate(batch_results) if raw_results is None]
+            for i, raw_results in zip(missing, self._select_many([selects[i] for i in missing])):
+                batch_results[i] = raw_results
+            changed = set()
+            for (q, current_query, parameters, current_limit), raw_results in zip(batch, batch_results):
+                current_id = q['id']
+                if changed & self._get_referential_parameter_names(q):
+                    parameters = self._get_query_parameters_and_append_pictures(
+                        q, current_query, user_parameters, referential_results, json_only, picture_context, user,
+                        selection)
+                    raw_results = None
+                try:
+                    if raw_results is None:
+                        raw_results = self._select(current_id, current_query, parameters, current_limit)
+                    size += len(raw_results)
+                    current_results = self.serializer.loads_bson(raw_results)
+                except:
+                    raise TemplateServiceError(
+                        'An error occured while executing query {}'.format(current_id))
+                if not current_results:
+                    raise TemplateServiceError(
+                        'Query {} returns nothing'.format(current_id))
+                if trigger_id is not None:
+                    self._set_trigger_results(trigger_id, (current_id, current_query, parameters, current_limit),
+                                              raw_results, generation)
                 if 'referential_results' in q and q['referential_results']:
-                    self._append_referential_results(
-                        row, q, referential_results, json_only, picture_context, language, user)
+                    previous = dict(referential_results)
+                    for row in current_results:
+                        self._append_referential_results(
+                            row, q, referential_results, records, json_only, picture_context, user, selection)
+                    changed.update(k for k, v in referential_results.items() if previous.get(k) is not v)
+                query_results[q['id']] = current_results
+        return {'referential': referential_results, 'query': query_results, 'records': records, 'size': size,
+                'sources': sources}
+
+    def _localize_template_data(self, data, template, language, user):
+        context = template['context']
+        referential_results = dict()
+        for k, v in data['referential'].items():
+            if k in data['records']:
+                v = dict(v, **data['records'][k].localized_names(language, self._get_names))
+            referential_results[k] = v
+
+        query_results = dict()
+        for q in template['queries']:
+            labelized_results = self._labelize_rows(data['query'][q['id']], q, language, context, user)
+            if q.get('format') == COLUMNAR:
+                labelized_results = to_columnar(labelized_results)
             query_results[q['id']] = labelized_results
-        results = {'referential': referential_results, 'query': query_results}
-        return results
+        return {'referential': referential_results, 'query': query_results}
 
     @staticmethod
     def _pick_picture_context(template, picture_context):
@@ -248,29 +532,96 @@ class TemplateService(object):
         _log.info('No picture context have been picked ...')
         return None
 
+    @staticmethod
+    def _get_svg_selection(template):
+        if template.get('kind') != 'image' or not template.get('svg'):
+            return None
+        return selection_for_svg(template['svg'])
+
+    def _build_svg_payload(self, json_results, selection):
+        results = self.serializer.loads(json_results)
+        if selection is not None:
+            results = selection.prune(results)
+        if self.pictures is not None:
+            slots = [(entry['picture'], _format) for entry in results.get('referential', {}).values()
+                     for _format, picture in (entry.get('picture') or {}).items() if picture]
+            if slots:
+                references = self.pictures.put_all([pictures[_format] for pictures, _format in slots])
+                for (pictures, _format), reference in zip(slots, references):
+                    pictures[_format] = reference
+        return results
+
     @staticmethod
     def _handle_trigger_referential_params(referential_params, event_id):
         event = {'id': event_id, 'event_or_entity': 'event'}
         return dict((k, v if 'from_event' not in v else event) for k, v in referential_params.items())
 
-    @rpc
-    def resolve(self, template_id, picture_context, language, json_only, referential, user_parameters,
-                user, text_to_path):
-        _log.info('{} is resolving template {} ...'.format(user, template_id))
-        _log.info('Picture context: {}'.format(picture_context))
-        _log.info('Language: {}'.format(language))
+    def _load_subscription(self, user):
+        sub = bson.json_util.loads(
+            self.subscription.get_subscription_by_user(user))
+        if not sub or 'subscription' not in sub:
+            _log.warning(f'Subscription not found for user {user}')
+            return None
+        notification = sub['subscription'].get('notification')
+        if notification is not None and 'channel' not in (notification.get('config') or {}):
+            _log.warning(f'Invalid notification configuration for user {user}')
+            notification = None
+        return {
+            'export': sub['subscription'].get('export'),
+            'notification': notification['config'] if notification is not None else None
+        }
+
+    def _get_subscription(self, user):
+        """ Returns the validated export and notification configurations of a user, a missing one is None """
+        subscription = self._lookup('subscriptions', ('subscription', user), lambda: self._load_subscription(user))
+        return subscription or {'export': None, 'notification': None}
+
+    def _export_infography(self, infography, filename, export_config):
+        """ Converts texts into paths and exports an SVG in a single exporter call, the converted SVG is not sent back.
+
+        Falls back on text_to_path then export when the exporter does not provide text_to_path_and_export.
+        """
+        payload = self.codec.encode(infography)
+        if self.exporter.supports('text_to_path_and_export'):
+            try:
+                return self.exporter.text_to_path_and_export(payload, filename, export_config)
+            except MethodNotFound:
+                _log.warning('Exporter does not provide text_to_path_and_export, using text_to_path then export')
+        converted = self.codec.decode(self.exporter.text_to_path(payload))
+        return self.exporter.export(self.codec.encode(converted), filename, export_config)
+
+    def _get_template(self, template_id, user):
         template = bson.json_util.loads(
-            self.metadata.get_template(template_id, user))
+            self._load_template(template_id, user))
         if not template:
             raise TemplateServiceError(
                 f'Template {template_id} not found or {user} not allowed to resolve template !')
-        template_language = language if language else template['language']
-        _log.info('Template will be resolved in {}'.format(template_language))
-        tmpl_pic_ctx = self._pick_picture_context(template, picture_context)
-
-        results = self._get_template_data(template, tmpl_pic_ctx, template_language, json_only,
-                                          referential, user_parameters, user)
-        json_results = json.dumps(results, cls=DateEncoder)
+        return template
+
+    def _upload_datasource(self, template, json_results, export_config):
+        """ Uploads the JSON data of an HTML template and returns its URL.
+
+        Without datasource in the template, CONTENT_ADDRESSED_DATASOURCES names the upload after the SHA-256 of the
+        data, which is only uploaded once per export configuration while its URL stays in the datasources cache.
+        """
+        if 'datasource' in template and template['datasource']:
+            return self.exporter.upload(self.codec.encode(json_results), template['datasource'], export_config)
+        if not self.config.get('CONTENT_ADDRESSED_DATASOURCES', False):
+            return self.exporter.upload(self.codec.encode(json_results), '{}.json'.format(str(uuid.uuid4())),
+                                        export_config)
+        digest = hashlib.sha256(json_results.encode('utf-8')).hexdigest()
+        config_digest = hashlib.sha1(
+            canonical_dumps(export_config).encode('utf-8')).hexdigest()
+
+        def upload():
+            _log.info('Uploading datasource {} ...'.format(digest))
+            return self.exporter.upload(self.codec.encode(json_results), '{}.json'.format(digest), export_config)
+        return self._lookup('datasources', ('datasource', config_digest, digest), upload)
+
+    def _render(self, template, results, json_only, text_to_path, selection, user, size_hint=0):
+        canonical = json_only is not True and template['kind'] != 'image'\
+            and self.config.get('CONTENT_ADDRESSED_DATASOURCES', False)
+        json_results = self.serializer.dumps(results, size_hint, canonical)
 
         if json_only is True:
             return {'content': json_results, 'mimetype': 'application/json'}
@@ -278,27 +629,25 @@ class TemplateService(object):
         if template['kind'] == 'image':
             try:
                 _log.info('Merging data and SVG template ...')
-                infography = self.svg_builder.replace_jsonpath(
-                    template['svg'], json.loads(json_results))
+                infography = self.codec.decode(self.svg_builder.replace_jsonpath(
+                    self.codec.encode(template['svg']), self._build_svg_payload(json_results, selection)))
             except:
                 raise TemplateServiceError('Wrong formated template !')
 
             if text_to_path is True:
                 _log.info('Converting text into path in generated SVG ...')
-                return {'content': self.exporter.text_to_path(infography), 'mimetype': 'image/svg+xml'}
+                return {'content': self.codec.decode(self.exporter.text_to_path(self.codec.encode(infography))),
+                        'mimetype': 'image/svg+xml'}
 
-            return {'content': self.exporter.to_plain_svg(infography), 'mimetype': 'image/svg+xml'}
+            return {'content': self.codec.decode(self.exporter.to_plain_svg(self.codec.encode(infography))),
+                    'mimetype': 'image/svg+xml'}
         else:
-            sub = bson.json_util.loads(
-                self.subscription.get_subscription_by_user(user))
-            if 'export' not in sub['subscription']:
+            export_config = self._get_subscription(user)['export']
+            if export_config is None:
                 raise TemplateServiceError(
                     'Export not configured for user {}'.format(user))
-            export_config = sub['subscription']['export']
-            filename = template['datasource'] if 'datasource' in template and template['datasource'] else "{}.json".format(
-                str(uuid.uuid4()))
             _log.info('Uploading JSON data on user\'s configured datasource ...')
-            url = self.exporter.upload(json_results, filename, export_config)
+            url = self._upload_datasource(template, json_results, export_config)
             html = template['html']
 
             if '${DATASOURCE}' not in template['html']:
@@ -309,6 +658,291 @@ class TemplateService(object):
                 'mimetype': 'text/html'
             }
 
+    @staticmethod
+    def _get_render_key(template_id, picture_context, language, json_only, referential, user_parameters, user,
+                        text_to_path):
+        return ('render', template_id, picture_context, language, json_only is True,
+                canonical_dumps(referential), canonical_dumps(user_parameters), user, text_to_path is True)
+
+    def _render_template(self, template, picture_context, language, json_only, referential, user_parameters, user,
+                         text_to_path):
+        """ Returns the rendered template and the (source, type) its queries depend on """
+        selection = self._get_svg_selection(template) if json_only is not True else None
+        data = self._fetch_template_data(template, picture_context, json_only, referential, user_parameters, user,
+                                         selection)
+        results = self._localize_template_data(data, template, language, user)
+        return self._render(template, results, json_only, text_to_path, selection, user, data['size']), data['sources']
+
+    @rpc
+    def resolve(self, template_id, picture_context, language, json_only, referential, user_parameters,
+                user, text_to_path):
+        _log.info('{} is resolving template {} ...'.format(user, template_id))
+        _log.info('Picture context: {}'.format(picture_context))
+        _log.info('Language: {}'.format(language))
+        template = self._get_template(template_id, user)
+        template_language = language if language else template['language']
+        _log.info('Template will be resolved in {}'.format(template_language))
+        tmpl_pic_ctx = self._pick_picture_context(template, picture_context)
+
+        rendered = self.cache['renders'].get(self._get_render_key(
+            template_id, tmpl_pic_ctx, template_language, json_only, referential, user_parameters, user, text_to_path))
+        if rendered is not None:
+            _log.info('Template {} served from the pre-rendered outputs'.format(template_id))
+            return rendered
+        return self._render_template(template, tmpl_pic_ctx, template_language, json_only, referential,
+                                     user_parameters, user, text_to_path)[0]
+
+    @rpc
+    def resolve_languages(self, template_id, picture_context, languages, json_only, referential, user_parameters,
+                          user, text_to_path):
+        """ Resolves a template in several languages, data is fetched once and results are keyed by language """
+        _log.info('{} is resolving template {} in {} ...'.format(user, template_id, languages))
+        template = self._get_template(template_id, user)
+        languages = languages if languages else [template['language']]
+        tmpl_pic_ctx = self._pick_picture_context(template, picture_context)
+        selection = self._get_svg_selection(template) if json_only is not True else None
+
+        data = self._fetch_template_data(template, tmpl_pic_ctx, json_only, referential, user_parameters, user,
+                                         selection)
+        results = dict()
+        for language in languages:
+            _log.info('Rendering template {} in {}'.format(template_id, language))
+            localized = self._localize_template_data(data, template, language, user)
+            results[language] = self._render(template, localized, json_only, text_to_path, selection, user,
+                                             data['size'])
+        return results
+
+    @rpc
+    def profile(self, seconds=30, mode='sampling', interval=0.005):
+        """ Profiles this service instance for a few seconds and returns the path of the profile written afterwards.
+
+        The sampling mode writes the folded stacks running on the hub every interval seconds of CPU time, the
+        deterministic mode writes the cProfile statistics of the resolve workers, each profiled only while it runs.
+        """
+        return self.profiler.start(seconds, mode, interval)
+
+    @rpc
+    def downstream_stats(self):
+        return dict((name, getattr(self, name).policy.summary()) for name in self.downstreams)
+
+    @rpc
+    def stats(self):
+        """ Returns the runtime statistics of this service instance, cheap enough to be polled every few seconds.
+
+        Workers in flight are counted per entrypoint, the stats call included, against the max_workers of the
+        container. The other sections are the trigger pipeline stages, the calls to downstream services, the
+        cache regions, the serialization, the notification channels and the running profiling session.
+        """
+        return {
+            'workers': self.metrics.workers(),
+            'pipeline': self.metrics.summary(),
+            'downstreams': self.downstream_stats(),
+            'caches': self.cache.stats(),
+            'serialization': self.serializer.summary(),
+            'notifications': self.notifications.summary(),
+            'profiling': self.profiler.status()
+        }
+
+    def _resolve_bundle_spec(self, spec, user):
+        try:
+            result = self.resolve(spec['template_id'], spec.get('picture_context'), spec.get('language'),
+                                  spec.get('json_only', False), spec.get('referential'), spec.get('user_parameters'),
+                                  user, spec.get('text_to_path', False))
+        except Exception as exc:
+            _log.error('Template {} of bundle failed: {}'.format(spec.get('template_id'), str(exc)))
+            return {'template_id': spec.get('template_id'), 'error': str(exc)}
+        return {'template_id': spec['template_id'], 'result': result}
+
+    @rpc
+    def resolve_bundle(self, specs, user):
+        """ Resolves concurrently a list of template specs (resolve arguments as a dict) sharing their downstream data.
+
+        At most BUNDLE_CONCURRENCY templates are resolved at once. Results are returned in the order of the specs,
+        a failing template gets an error instead of a result.
+        """
+        _log.info('{} is resolving a bundle of {} templates ...'.format(user, len(specs)))
+        self.working_set = WorkingSet()
+        pool = eventlet.GreenPool(int(self.config.get('BUNDLE_CONCURRENCY', 8)))
+        results = list(pool.imap(lambda spec: self._resolve_bundle_spec(spec, user), specs))
+        _log.info('Bundle resolved with {} shared downstream results'.format(self.working_set.hits))
+        return results
+
+    def _prefetch_event(self, event_id, config):
+        """ Warms the caches with an event, its entities, their pictures and the configured templates data """
+        for user in config.get('users', []):
+            event = bson.json_util.loads(self._get_event(event_id, user) or 'null')
+            if not event:
+                _log.info(f'Event {event_id} not found, nothing to prefetch for {user}')
+                continue
+            for entity in event.get('entities', []):
+                self._get_entity(entity['id'], user)
+                for picture in config.get('pictures', []):
+                    try:
+                        self._get_entity_picture(entity['id'], picture.get('context', 'default'), picture['format'],
+                                                 user, picture.get('kind', 'bitmap'))
+                    except Exception as exc:
+                        _log.warning(f'Picture {picture["format"]} of {entity["id"]} not prefetched: {str(exc)}')
+                eventlet.sleep(0)
+            for spec in config.get('templates', []):
+                try:
+                    template = self._get_template(spec['id'], user)
+                    referential = self._handle_trigger_referential_params(spec.get('referential', {}), event_id)
+                    self._fetch_template_data(template, None, True, referential, spec.get('user_parameters'), user)
+                except Exception as exc:
+                    _log.warning(f'Template {spec["id"]} not prefetched for event {event_id}: {str(exc)}')
+        _log.info(f'Event {event_id} prefetched')
+
+    def _prerender(self, event_id, spec, language, picture_context, user):
+        template = self._get_template(spec['id'], user)
+        language = language if language else template['language']
+        picture_context = self._pick_picture_context(template, picture_context)
+        referential = None
+        if spec.get('referential') is not None:
+            referential = self._handle_trigger_referential_params(spec['referential'], event_id)
+        json_only = spec.get('json_only', False)
+        text_to_path = spec.get('text_to_path', False)
+        key = self._get_render_key(spec['id'], picture_context, language, json_only, referential,
+                                   spec.get('user_parameters'), user, text_to_path)
+        if key in self.cache['renders']:
+            return
+        generation = self.cache['renders'].generation()
+        rendered, sources = self._render_template(template, picture_context, language, json_only, referential,
+                                                  spec.get('user_parameters'), user, text_to_path)
+        if not self.cache['renders'].set(key, rendered, tags=sources, generation=generation):
+            _log.info(f'Template {spec["id"]} pre-rendered for event {event_id} is already outdated')
+            return
+        _log.info(f'Template {spec["id"]} pre-rendered in {language} for event {event_id}')
+
+    def _schedule_prerender(self, event_id, specs, user):
+        scheduled = 0
+        for spec in specs:
+            for language in spec.get('languages') or [None]:
+                for picture_context in spec.get('picture_contexts') or [None]:
+                    self.tasks.spawn(f'prerender {spec["id"]}', self._prerender, event_id, spec, language,
+                                     picture_context, user)
+                    scheduled += 1
+        return scheduled
+
+    @rpc
+    def prerender(self, event_id, specs, user):
+        """ Renders templates of an event in the background into the rendered outputs served by resolve.
+
+        A spec holds the template id, its languages and picture_contexts, json_only, text_to_path, user_parameters
+        and referential, whose entries with from_event are the event. Returns the number of scheduled renders.
+        """
+        _log.info('{} is scheduling the pre-rendering of {} templates for event {}'.format(user, len(specs), event_id))
+        return self._schedule_prerender(event_id, specs, user)
+
+    def _resolve_trigger(self, job):
+        t = job['trigger']
+        sub = self._get_subscription(t['user'])
+        if sub['export'] is None:
+            _log.warning(f'Export not configured for user {t["user"]}')
+            return None
+        res = self.referential.get_event_filtered_by_entities(job['content_id'],
+                                                              t['selector'], t['user'])
+        event = bson.json_util.loads(res)
+        if not event:
+            _log.info('No event has been found !')
+            return None
+
+        _log.info(f'Refreshing trigger {t["id"]} on event {event["id"]}')
+        spec = t['template']
+        template = bson.json_util.loads(
+            self._load_template(spec['id'], t['user']))
+        if not template:
+            _log.error(f'Template {spec["id"]} not found')
+            return None
+        picture_context = None
+        if template['picture']:
+            picture_context = template['picture']['context']
+        if 'picture' in spec and 'context' in spec['picture']:
+            picture_context = spec['picture']['context']
+
+        language = spec.get('language', template['language'])
+        json_only = spec.get('json_only', False)
+        referential = None
+        if 'referential' in spec:
+            referential = self._handle_trigger_referential_params(
+                spec['referential'], job['content_id'])
+        user_parameters = spec.get('user_parameters', None)
+        selection = None
+        if not (json_only and t['export']['format'] == 'json'):
+            selection = self._get_svg_selection(template)
+
+        data = self._fetch_template_data(template, picture_context, json_only, referential, user_parameters,
+                                         t['user'], selection, trigger_id=t['id'])
+        result = self._localize_template_data(data, template, language, t['user'])
+        return dict(job, subscription=sub, template=template, selection=selection,
+                    json_export=json_only and t['export']['format'] == 'json',
+                    json_results=self.serializer.dumps(result, data['size']))
+
+    def _render_trigger(self, job):
+        if job['json_export']:
+            return job
+        infography = self.codec.decode(self.svg_builder.replace_jsonpath(
+            self.codec.encode(job['template']['svg']), self._build_svg_payload(job['json_results'], job['selection'])))
+        return dict(job, infography=infography)
+
+    def _export_trigger(self, job):
+        t = job['trigger']
+        export_config = job['subscription']['export']
+        if job['json_export']:
+            self.exporter.upload(
+                self.codec.encode(job['json_results']), t['export']['filename'], export_config)
+            return None
+        filename = t['export'].get(
+            'filename', '.'.join([str(uuid.uuid4()), t['export']['format']]))
+        return dict(job, url=self._export_infography(job['infography'], filename, export_config))
+
+    def _notify_trigger(self, job):
+        t = job['trigger']
+        notif_config = job['subscription']['notification']
+        if notif_config is None:
+            _log.warning(
+                f'{t["user"]} notification configuration not found !')
+            return None
+        self.notifications.send(f'#{notif_config["channel"]}', t['name'], job['url'], t['id'])
+
+    def _run_trigger_pipeline(self, jobs):
+        """ Refreshes fired triggers through the resolve, render, export and notify stages.
+
+        Each stage has the concurrency and queue size configured under TRIGGER_PIPELINE, so that the triggers
+        of an event wait on different downstream services at the same time. Triggers are queued in the trigger
+        queue shared by the pipelines of all the events being handled, and enter a pipeline by weighted round
+        robin over their users, so that a user firing many triggers does not hold back the others across events.
+        A pipeline runs until the shared queue is empty, so its worker also refreshes the triggers of the events
+        queued meanwhile, and keeps running for as long as events keep coming. When TRIGGER_SCHEDULING.pipelines
+        of them are already draining the queue, the worker returns at once: its triggers are refreshed by another
+        worker, with the dependencies and proxies of that worker. Triggers still queued when the container stops
+        are lost.
+        """
+        config = self.config.get('TRIGGER_PIPELINE') or {}
+        scheduling = self.config.get('TRIGGER_SCHEDULING') or {}
+        for job in jobs:
+            self.trigger_queue.put(job['trigger']['user'], job)
+        if self.trigger_queue.consumers >= scheduling.get('pipelines', 2):
+            _log.info(f'{len(jobs)} triggers queued for the running trigger pipelines')
+            return
+        stages = list()
+        for name, fn in (('resolve', self._resolve_trigger), ('render', self._render_trigger),
+                         ('export', self._export_trigger), ('notify', self._notify_trigger)):
+            options = dict(TRIGGER_STAGES[name], **(config.get(name) or {}))
+            stages.append(Stage(name, fn, self.metrics.stage(f'trigger_{name}'),
+                                options['concurrency'], options['queue_size']))
+        Pipeline(stages).run(self.trigger_queue.drain())
+
+    @event_handler(
+        'subscription_manager', 'subscription_updated', handler_type=BROADCAST, reliable_delivery=False)
+    def handle_subscription_updated(self, payload):
+        """ Drops the cached subscription of the user given in the payload, or all of them without user """
+        msg = bson.json_util.loads(payload) if payload else None
+        if msg and msg.get('user'):
+            self.cache['subscriptions'].invalidate(('subscription', msg['user']))
+        else:
+            self.cache['subscriptions'].clear()
+        _log.info('Subscription cache invalidated for {}'.format(msg.get('user') if msg else 'all users'))
+
     @event_handler(
         'loader', 'input_loaded', handler_type=BROADCAST, reliable_delivery=False)
     def handle_input_loaded(self, payload):
@@ -323,63 +957,23 @@ class TemplateService(object):
         _log.info(
             f'Input event {msg["id"]} received, checking if there is a trigger to refresh ...')
         on_event = {'source': meta['source'], 'type': meta['type']}
+        invalidated = self.cache['query_results'].invalidate_tags([(meta['source'], meta['type']), UNDECLARED_SOURCE])
+        _log.info(f'{invalidated} cached query results invalidated')
+        invalidated = self.cache['renders'].invalidate_tags([(meta['source'], meta['type']), UNDECLARED_SOURCE])
+        _log.info(f'{invalidated} pre-rendered outputs invalidated')
+        invalidated = self.cache['trigger_results'].invalidate_tags([(meta['source'], meta['type']), UNDECLARED_SOURCE])
+        _log.info(f'{invalidated} trigger query results invalidated')
         #####
+        content_id = meta.get('content_id', msg['id'])
+        invalidated = self.cache['events'].invalidate_tags([('event', content_id)])
+        _log.info(f'{invalidated} cached events invalidated')
+        prefetch = self.config.get('PREFETCH') or {}
+        if prefetch.get('enabled', False):
+            self.tasks.spawn(f'prefetch {content_id}', self._prefetch_event, content_id, prefetch)
+        prerender = self.config.get('PRERENDER') or {}
+        if prerender.get('enabled', False):
+            for user in prerender.get('users', []):
+                self._schedule_prerender(content_id, prerender.get('templates', []), user)
         triggers = bson.json_util.loads(
             self.metadata.get_fired_triggers(on_event))
-        content_id = meta.get('content_id', msg['id'])
-        for t in triggers:
-            sub = bson.json_util.loads(
-                self.subscription.get_subscription_by_user(t['user']))
-            if 'export' not in sub['subscription']:
-                _log.warning(f'Export not configured for user {t["user"]}')
-                continue
-            export_config = sub['subscription']['export']
-            res = self.referential.get_event_filtered_by_entities(content_id,
-                                                                  t['selector'], t['user'])
-            event = bson.json_util.loads(res)
-            if not event:
-                _log.info('No event has been found !')
-                continue
-
-            _log.info(f'Refreshing trigger {t["id"]} on event {event["id"]}')
-            spec = t['template']
-            template = bson.json_util.loads(
-                self.metadata.get_template(spec['id'], t['user']))
-            if not template:
-                _log.error(f'Template {spec["id"]} not found')
-                continue
-            picture_context = None
-            if template['picture']:
-                picture_context = template['picture']['context']
-            if 'picture' in spec and 'context' in spec['picture']:
-                picture_context = spec['picture']['context']
-
-            language = spec.get('language', template['language'])
-            json_only = spec.get('json_only', False)
-            referential = None
-            if 'referential' in spec:
-                referential = self._handle_trigger_referential_params(
-                    spec['referential'], content_id)
-            user_parameters = spec.get('user_parameters', None)
-
-            result = self._get_template_data(template, picture_context, language, json_only,
-                                             referential, user_parameters, t['user'])
-            json_results = json.dumps(result, cls=DateEncoder)
-            if json_only and t['export']['format'] == 'json':
-                url = self.exporter.upload(
-                    json_results, t['export']['filename'], export_config)
-            else:
-                infography = self.svg_builder.replace_jsonpath(
-                    template['svg'], json.loads(json_results))
-                result = self.exporter.text_to_path(infography)
-                filename = t['export'].get(
-                    'filename', '.'.join([str(uuid.uuid4()), t['export']['format']]))
-                url = self.exporter.export(
-                    result, filename, export_config)
-                if 'notification' not in sub['subscription']:
-                    _log.warning(
-                        f'{t["user"]} notification configuration not found !')
-                    continue
-                notif_config = sub['subscription']['notification']['config']
-                self.notifier.send_to_slack(
-                    f'#{notif_config["channel"]}', t['name'], image_url=url, context=t['id'])
+        self._run_trigger_pipeline([{'trigger': t, 'content_id': content_id} for t in triggers])
@@ -0,0 +1,79 @@
+from eventlet.event import Event
+
+
+class WorkingSet(object):
+    """ Memoizes the downstream calls of one request so that concurrent renders share their results.
+
+    A call already in flight for the same key is awaited instead of being sent again.
+    """
+
+    def __init__(self):
+        self.values = dict()
+        self.pending = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def knows(self, key):
+        return key in self.values or key in self.pending
+
+    def get(self, key, fn, *args, **kwargs):
+        if key in self.values:
+            self.hits += 1
+            return self.values[key]
+        if key in self.pending:
+            self.hits += 1
+            return self.pending[key].wait()
+
+        self.misses += 1
+        event = Event()
+        self.pending[key] = event
+        try:
+            value = fn(*args, **kwargs)
+        except Exception as exc:
+            del self.pending[key]
+            event.send_exception(exc)
+            raise
+        self.values[key] = value
+        del self.pending[key]
+        event.send(value)
+        return value
+
+    def get_many(self, keys, fn):
+        """ Runs fn once for the keys neither known nor in flight, concurrent gets of these keys wait for it.
+
+        fn is given these keys and returns, in their order, the value of each key or the exception to raise for it.
+        Returns the values of all the keys, the other ones being taken from the set or awaited.
+        """
+        known = dict()
+        events = dict()
+        for key in keys:
+            if key in self.values or key in self.pending:
+                known[key] = self.pending.get(key)
+            elif key not in events:
+                events[key] = Event()
+        claimed = list(events)
+        self.pending.update(events)
+        self.hits += len(known)
+        self.misses += len(claimed)
+        try:
+            values = fn(claimed) if claimed else []
+        except Exception as exc:
+            for key, event in events.items():
+                del self.pending[key]
+                event.send_exception(exc)
+            raise
+        for key, value in zip(claimed, values):
+            del self.pending[key]
+            if isinstance(value, Exception):
+                events[key].send_exception(value)
+            else:
+                self.values[key] = value
+                events[key].send(value)
+        results = list()
+        for key in keys:
+            if key in events:
+                event = events[key]
+            else:
+                event = known[key]
+            results.append(self.values[key] if event is None else event.wait())
+        return results
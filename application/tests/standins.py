@@ -0,0 +1,70 @@
+from application.dependencies.compression import decode
+
+
+class LocalSvgBuilder(object):
+    """ Stand-in for the svg_builder service, the template is returned without substitution """
+
+    def replace_jsonpath(self, svg, data):
+        return decode(svg)
+
+
+class LocalDatareader(object):
+    """ Stand-in for the datareader service running queries with a select(sql, parameters, limit) function """
+
+    def __init__(self, select):
+        self.run = select
+
+    @staticmethod
+    def supports(method_name):
+        return hasattr(LocalDatareader, method_name)
+
+    def select(self, sql, parameters, limit=50):
+        return self.run(sql, parameters, limit)
+
+    def select_many(self, selects):
+        replies = list()
+        for select in selects:
+            try:
+                replies.append({'results': self.run(select['sql'], select['parameters'], select['limit'])})
+            except Exception as exc:
+                replies.append({'error': str(exc)})
+        return replies
+
+
+class LocalExporter(object):
+    """ Stand-in for the exporter service keeping exported and uploaded contents in memory """
+
+    def __init__(self):
+        self.files = dict()
+
+    @staticmethod
+    def supports(method_name):
+        return hasattr(LocalExporter, method_name)
+
+    def text_to_path(self, svg):
+        return decode(svg)
+
+    def to_plain_svg(self, svg):
+        return decode(svg)
+
+    def export(self, svg, filename, export_config):
+        self.files[filename] = decode(svg)
+        return 'https://exports.local/{}'.format(filename)
+
+    def text_to_path_and_export(self, svg, filename, export_config):
+        return self.export(self.text_to_path(svg), filename, export_config)
+
+    def upload(self, content, filename, export_config):
+        self.files[filename] = decode(content)
+        return 'https://uploads.local/{}'.format(filename)
+
+
+class InlineTasks(object):
+    """ Stand-in for the background tasks dependency running tasks synchronously """
+
+    def __init__(self):
+        self.names = list()
+
+    def spawn(self, name, fn, *args, **kwargs):
+        self.names.append(name)
+        fn(*args, **kwargs)
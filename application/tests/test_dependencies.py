@@ -0,0 +1,335 @@
+import datetime
+import os
+import pstats
+import pytest
+
+import eventlet
+from nameko.exceptions import MethodNotFound
+
+from application.dependencies.cache import Caches, TTLCache
+from application.dependencies.notifications import Dispatcher
+from application.dependencies.pictures import REFERENCE_PREFIX, PictureStore
+from application.dependencies.profiling import Profiler, ProfilingError
+from application.dependencies.rpc import CallPolicy, DeadlineExceeded, ResilientServiceProxy
+from application.dependencies.scheduling import FairQueue
+from application.dependencies.serialization import ProcessPool, Serializer
+
+
+class FakeReply(object):
+
+    def __init__(self, delay, value):
+        self.delay = delay
+        self.value = value
+
+    def result(self):
+        eventlet.sleep(self.delay)
+        if isinstance(self.value, Exception):
+            raise self.value
+        return self.value
+
+
+class FakeMethod(object):
+
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.calls = 0
+
+    def call_async(self, *args, **kwargs):
+        self.calls += 1
+        return self.replies.pop(0)
+
+
+class FakeServiceProxy(object):
+
+    def __init__(self, **methods):
+        self.methods = methods
+
+    def __getattr__(self, name):
+        return self.methods[name]
+
+
+def test_call_policy_deadline():
+    policy = CallPolicy('referential', {'default': 1, 'get_entity_picture': 0.01})
+    proxy = ResilientServiceProxy(FakeServiceProxy(
+        get_entity_picture=FakeMethod(FakeReply(0.5, 'picture'))), policy)
+    with pytest.raises(DeadlineExceeded):
+        proxy.get_entity_picture('t144', 'default', 'standard', 'my_user', 'bitmap')
+    assert policy.summary()['get_entity_picture']['timeouts'] == 1
+
+
+def test_call_policy_hedge_wins():
+    policy = CallPolicy('datareader', hedged=True, min_samples=2)
+    method = FakeMethod(FakeReply(0, 'a'), FakeReply(0, 'b'), FakeReply(0.5, 'slow'), FakeReply(0, 'fast'),
+                        FakeReply(0.05, 'primary'), FakeReply(0, ValueError('boom')),
+                        FakeReply(0.3, ValueError('primary failed')), FakeReply(0, ValueError('hedge failed')))
+    proxy = ResilientServiceProxy(FakeServiceProxy(select=method), policy)
+    assert proxy.select('SELECT 1', None, limit=1) == 'a'
+    assert proxy.select('SELECT 1', None, limit=1) == 'b'
+    assert proxy.select('SELECT 1', None, limit=1) == 'fast'
+    assert method.calls == 4
+    assert proxy.select('SELECT 1', None, limit=1) == 'primary'
+    with pytest.raises(ValueError, match='hedge failed'):
+        proxy.select('SELECT 1', None, limit=1)
+    stats = policy.summary()['select']
+    assert stats['hedged'] == 3
+    assert stats['hedge_wins'] == 1
+    assert stats['errors'] == 1
+
+
+def test_call_policy_not_hedged_propagates_errors():
+    policy = CallPolicy('exporter', min_samples=0)
+    method = FakeMethod(FakeReply(0, ValueError('boom')))
+    proxy = ResilientServiceProxy(FakeServiceProxy(export=method), policy)
+    with pytest.raises(ValueError):
+        proxy.export('<svg></svg>', 'export.png', {})
+    assert method.calls == 1
+    assert policy.summary()['export']['errors'] == 1
+
+
+def test_call_policy_remembers_unavailable_methods():
+    clock = FakeClock()
+    policy = CallPolicy('exporter', min_samples=0, unavailable_ttl=60, clock=clock)
+    proxy = ResilientServiceProxy(FakeServiceProxy(
+        text_to_path_and_export=FakeMethod(FakeReply(0, MethodNotFound('text_to_path_and_export')))), policy)
+    assert proxy.supports('text_to_path_and_export')
+    with pytest.raises(MethodNotFound):
+        proxy.text_to_path_and_export('<svg></svg>', 'export.png', {})
+    assert not proxy.supports('text_to_path_and_export')
+    assert proxy.supports('export')
+    clock.now = 61
+    assert proxy.supports('text_to_path_and_export')
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_cache():
+    clock = FakeClock()
+    cache = TTLCache(maxsize=2, ttl=10, clock=clock)
+    cache.set('a', 1, tags=[('opta', 'f9')])
+    cache.set('b', 2, tags=[('opta', 'f24')])
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.evictions == 1
+    assert cache.invalidate_tags([('opta', 'f9')]) == 1
+    assert cache.get('a') is None
+    clock.now = 11
+    assert cache.get('c') is None
+    assert cache.stats()['hits'] == 1
+
+
+def test_caches_snapshot(tmpdir):
+    store = PictureStore(str(tmpdir.join('pictures')))
+    path = str(tmpdir.join('snapshot.json.gz'))
+    caches = Caches()
+    caches['templates'].set(('template', 'dsa_fbl_mt_duel', 'my_user'), '{"id": "dsa_fbl_mt_duel"}')
+    caches['events'].set(('event', 'f985507', 'my_user'), '{"id": "f985507"}', tags=[('event', 'f985507')])
+    caches['query_results'].set(('select', 'q', 'hash', '["f985507"]', 50), '[]', tags=[('opta', 'f9')])
+    caches['pictures'].set(('picture', 't144', 'default', 'standard', 'my_user', 'bitmap'), '<svg/>')
+    assert caches.dump(path, store) == 3
+
+    restored = Caches()
+    assert restored.load(path, 900, store) == 3
+    assert restored['templates'].get(('template', 'dsa_fbl_mt_duel', 'my_user')) == '{"id": "dsa_fbl_mt_duel"}'
+    assert restored['pictures'].get(('picture', 't144', 'default', 'standard', 'my_user', 'bitmap')) == '<svg/>'
+    assert restored['events'].invalidate_tags([('event', 'f985507')]) == 1
+    assert len(restored['query_results']) == 0
+    assert Caches().load(path, 900) == 2
+    assert Caches().load(path, -1) == 0
+
+
+def test_picture_store_writes_removed_pictures_again(tmpdir):
+    store = PictureStore(str(tmpdir))
+    reference, = store.put_all(['<svg/>'])
+    assert store.get(reference) == '<svg/>'
+    os.remove(store._path(reference[len(REFERENCE_PREFIX):]))
+    assert store.put_all(['<svg/>', '<svg/>']) == [reference, reference]
+    assert store.get(reference) == '<svg/>'
+
+
+def test_ttl_cache_stale_entries():
+    clock = FakeClock()
+    cache = TTLCache(maxsize=2, ttl=10, stale_ttl=5, clock=clock)
+    cache.set('a', 1)
+    assert cache.get_entry('a') == (1, False)
+    clock.now = 12
+    assert cache.get('a') is None
+    assert cache.get_entry('a') == (1, True)
+    assert cache.start_refresh('a')
+    assert not cache.start_refresh('a')
+    cache.end_refresh('a')
+    clock.now = 16
+    assert cache.get_entry('a') == (None, False)
+    assert len(cache) == 0
+
+
+def test_ttl_cache_skips_values_invalidated_while_computed():
+    cache = TTLCache(maxsize=2)
+    generation = cache.generation()
+    cache.invalidate_tags([('opta', 'f9')])
+    assert not cache.set('a', 1, tags=[('opta', 'f9')], generation=generation)
+    assert cache.set('b', 2, tags=[('opta', 'f1')], generation=generation)
+    assert 'a' not in cache and 'b' in cache
+    generation = cache.generation()
+    cache.invalidate_tags([('opta', 'f9'), ('opta', 'f24'), ('opta', 'f40')])
+    assert not cache.set('c', 3, tags=[('opta', 'f1')], generation=generation)
+    assert cache.set('c', 3, tags=[('opta', 'f1')], generation=cache.generation())
+    generation = cache.generation()
+    cache.clear()
+    assert not cache.set('d', 4, generation=generation)
+
+
+def test_serializer_offloads_large_payloads():
+    pool = ProcessPool(1)
+    try:
+        serializer = Serializer(pool, threshold=16)
+        results = [{'date': datetime.datetime(2019, 5, 4, 15, 0), 'value': 1}]
+        assert serializer.dumps(results, size_hint=1024) == '[{"date": "2019-05-04T15:00:00", "value": 1}]'
+        assert serializer.loads_bson('[{"value": {"$numberLong": "2"}}]') == [{'value': 2}]
+        assert serializer.loads('[]') == []
+        summary = serializer.summary()
+        assert summary['dumps']['offloaded'] == 1
+        assert summary['loads_bson']['offloaded'] == 1
+        assert summary['loads']['inline'] == 1
+    finally:
+        pool.close()
+    assert serializer.loads('{"a": 1}') == {'a': 1}
+    assert serializer.summary()['loads']['inline'] == 2
+    assert serializer.dumps({'b': {2: 'x', '10': 'y'}, 'a': [{None: 1}]}, canonical=True) == \
+        '{"a":[{"null":1}],"b":{"10":"y","2":"x"}}'
+
+
+def test_serializer_replaces_failed_workers():
+    pool = ProcessPool(1)
+    try:
+        serializer = Serializer(pool, threshold=16)
+        pool.processes[0].kill()
+        pool.processes[0].wait()
+        with eventlet.Timeout(10):
+            assert serializer.loads('[{"value": 1}, {"value": 2}]') == [{'value': 1}, {'value': 2}]
+            assert serializer.summary()['loads'] == dict(serializer.summary()['loads'], inline=1, offloaded=0)
+            assert serializer.loads('[{"value": 3}, {"value": 4}]') == [{'value': 3}, {'value': 4}]
+            assert serializer.summary()['loads']['offloaded'] == 1
+        assert len(pool.processes) == 1
+    finally:
+        pool.close()
+
+
+class FakeNotifier(object):
+
+    def __init__(self, failures=0, batches=True, failing_texts=()):
+        self.failures = failures
+        self.batches = batches
+        self.failing_texts = set(failing_texts)
+        self.sent = list()
+        self.batch_calls = 0
+
+    def send_to_slack(self, channel, text, image_url=None, context=None):
+        if text in self.failing_texts:
+            self.failing_texts.remove(text)
+            raise ValueError('rate limited')
+        self.sent.append((channel, [{'text': text, 'image_url': image_url, 'context': context}]))
+
+    def send_images_to_slack(self, channel, images):
+        self.batch_calls += 1
+        if not self.batches:
+            raise MethodNotFound('send_images_to_slack')
+        if self.failures:
+            self.failures -= 1
+            raise ValueError('rate limited')
+        self.sent.append((channel, images))
+
+
+def test_dispatcher_batches_notifications_per_channel():
+    notifier = FakeNotifier(failures=1)
+    dispatcher = Dispatcher(eventlet.spawn, notifier, window=0.01, min_interval=0.01, max_batch=2)
+    for i in range(3):
+        dispatcher.send('#a', 'trigger {}'.format(i), 'https://exports.local/{}.png'.format(i), i)
+    dispatcher.send('#b', 'trigger', 'https://exports.local/b.png', 'b')
+    eventlet.sleep(0.2)
+    assert notifier.sent[0] == ('#b', [{'text': 'trigger', 'image_url': 'https://exports.local/b.png', 'context': 'b'}])
+    assert [(channel, len(images)) for channel, images in notifier.sent[1:]] == [('#a', 2), ('#a', 1)]
+    summary = dispatcher.summary()
+    assert summary['#a'] == {'queued': 3, 'messages': 3, 'batches': 2, 'failures': 1, 'dropped': 0}
+    assert not dispatcher.pending
+
+
+def test_dispatcher_retries_undelivered_notifications():
+    notifier = FakeNotifier(batches=False, failing_texts=['trigger 1'])
+    dispatcher = Dispatcher(eventlet.spawn, notifier, window=0.01, min_interval=0.01, max_batch=3)
+    for i in range(3):
+        dispatcher.send('#a', 'trigger {}'.format(i), 'https://exports.local/{}.png'.format(i), i)
+    eventlet.sleep(0.2)
+    assert [images[0]['text'] for _, images in notifier.sent] == ['trigger 0', 'trigger 1', 'trigger 2']
+    assert dispatcher.summary()['#a'] == {'queued': 3, 'messages': 3, 'batches': 1, 'failures': 1, 'dropped': 0}
+    assert notifier.batch_calls == 1
+    assert not dispatcher.supports('send_images_to_slack')
+
+    notifier = FakeNotifier(failures=10)
+    dispatcher = Dispatcher(eventlet.spawn, notifier, window=0.01, min_interval=0.01, max_interval=0.02, retries=4)
+    for i in range(2):
+        dispatcher.send('#a', 'trigger {}'.format(i), 'https://exports.local/{}.png'.format(i), i)
+    eventlet.sleep(0.3)
+    assert dispatcher.summary()['#a']['dropped'] == 2
+    assert dispatcher.intervals['#a'] == 0.02
+
+
+def busy_loop():
+    return sum(i * i for i in range(200000))
+
+
+def other_loop():
+    return sum(i * i for i in range(200000))
+
+
+def profiled_worker(profiler):
+    profiler.enter()
+    busy_loop()
+    eventlet.sleep(0)
+    busy_loop()
+    profiler.exit()
+
+
+def other_worker():
+    other_loop()
+    eventlet.sleep(0)
+    other_loop()
+
+
+def test_profiler_sessions(tmpdir):
+    profiler = Profiler(eventlet.spawn, str(tmpdir), max_seconds=0.2)
+    session = profiler.start(10, 'deterministic')
+    assert session['seconds'] == 0.2
+    with pytest.raises(ProfilingError):
+        profiler.start(1)
+    workers = [eventlet.spawn(profiled_worker, profiler), eventlet.spawn(other_worker)]
+    for worker in workers:
+        worker.wait()
+    eventlet.sleep(0.3)
+    assert profiler.status() is None
+    functions = pstats.Stats(session['path']).stats
+    assert functions[next(f for f in functions if f[2] == 'busy_loop')][0] == 2
+    assert not any(name == 'other_loop' for _, _, name in functions)
+
+    session = profiler.start(0.2, 'sampling', 0.001)
+    for _ in range(5):
+        busy_loop()
+    eventlet.sleep(0.3)
+    with open(session['path']) as f:
+        assert 'busy_loop' in f.read()
+
+
+def test_fair_queue_pops_by_weighted_round_robin():
+    jobs = [('a', 1), ('a', 2), ('a', 3), ('a', 4), ('b', 1), ('c', 1), ('c', 2)]
+    queue = FairQueue({'a': 2})
+    for job in jobs:
+        queue.put(job[0], job)
+    assert list(queue.drain()) == [('a', 1), ('a', 2), ('b', 1), ('c', 1), ('a', 3), ('a', 4), ('c', 2)]
+    assert queue.pop() is None and queue.consumers == 0
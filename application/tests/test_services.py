@@ -1,9 +1,34 @@
 import pytest
 
 import json
+import eventlet
+from unittest.mock import MagicMock
+from nameko.exceptions import MethodNotFound
 from nameko.testing.services import worker_factory
 
-from application.services.template import TemplateService
+from application.services.template import TemplateService, TemplateServiceError
+from application.services.jsonpath import selection_for_svg
+from application.services.formats import to_records
+from application.services.pipeline import Pipeline, Stage
+from application.dependencies.pictures import PictureStore
+from application.dependencies.compression import Codec, is_envelope
+from application.dependencies.cache import Caches
+from application.dependencies.metrics import Metrics
+from application.dependencies.notifications import Dispatcher
+from application.dependencies.scheduling import FairQueue
+from application.dependencies.serialization import Serializer
+from application.tests.standins import LocalDatareader, LocalExporter, LocalSvgBuilder, InlineTasks
+
+def create_service(**dependencies):
+    dependencies.setdefault('pictures', None)
+    dependencies.setdefault('codec', Codec())
+    dependencies.setdefault('cache', Caches())
+    dependencies.setdefault('tasks', InlineTasks())
+    dependencies.setdefault('serializer', Serializer())
+    dependencies.setdefault('metrics', Metrics())
+    dependencies.setdefault('config', {})
+    dependencies.setdefault('trigger_queue', FairQueue())
+    return worker_factory(TemplateService, **dependencies)
 
 @pytest.fixture
 def template():
@@ -960,28 +985,440 @@ def subscription():
     }
     """
 
-def test_resolve(template, queries, event, entities, query_results):
-    service = worker_factory(TemplateService)
-    service.metadata.get_template.return_value = template
-    service.metadata.get_query.side_effect = queries
-    service.referential.get_event_by_id.return_value = event
-    service.referential.get_entity_by_id.side_effect = entities
+@pytest.fixture
+def resolving_service(template, queries, event, entities, query_results):
+    """ Returns a create_service variant whose downstream mocks resolve the template fixtures """
+
+    def create(template=template, **dependencies):
+        service = create_service(**dependencies)
+        service.metadata.get_template.return_value = template
+        service.metadata.get_query.side_effect = queries
+        service.referential.get_event_by_id.return_value = event
+        service.referential.get_entity_by_id.side_effect = entities
+        if 'datareader' not in dependencies:
+            service.datareader.select.side_effect = query_results
+        service.referential.get_labels_by_id_and_language_and_context.return_value = {'label': 'mylabel'}
+        return service
+    return create
+
+def test_resolve(resolving_service):
+    service = resolving_service()
+    service.referential.get_entity_picture.return_value = 'picture'
+    service.resolve('dsa_fbl_mt_duel', 'default', 'FR',
+                    False, {'match': {'id': 'f985507', 'event_or_entity': 'event'}}, None, 'my_user', True)
+
+def test_handle_input_loaded(triggers, event, subscription, resolving_service):
+    service = resolving_service()
+    service.referential.get_entity_picture.return_value = 'picture'
+    service.metadata.get_fired_triggers.return_value = triggers
+    service.referential.get_event_filtered_by_entities.return_value = event
+    service.subscription.get_subscription_by_user.return_value = subscription
+    service.handle_input_loaded('{"meta": {"source": "opta", "type": "f9", "content_id": "f985507"}, "id": "985507"}')
+
+def test_selection_for_svg():
+    selection = selection_for_svg(
+        '<svg><text>$.query.soccer_match_infos[0].attendance</text>'
+        '<image href="$.referential.Home.picture.standard"/><text>$.referential.match.display_name</text></svg>')
+    assert selection.reaches(('referential', 'Home', 'picture', 'standard'))
+    assert not selection.reaches(('referential', 'Away', 'picture', 'standard'))
+    data = {
+        'referential': {'Home': {'id': 't153', 'picture': {'standard': 'picture'}}, 'Away': {'id': 't144'},
+                        'match': {'id': 'f985507', 'display_name': 'Strasbourg - Marseille'}},
+        'query': {'soccer_match_infos': [{'attendance': 25962, 'pool': None}, {'attendance': 1, 'pool': None}],
+                  'soccer_match_team_stats': [{'type': 'total_pass'}]}
+    }
+    assert selection.prune(data) == {
+        'referential': {'Home': {'picture': {'standard': 'picture'}}, 'match': {'display_name': 'Strasbourg - Marseille'}},
+        'query': {'soccer_match_infos': [{'attendance': 25962}, {'attendance': 1}]}
+    }
+    assert selection_for_svg('<svg><text>$..attendance</text></svg>') is None
+    assert selection_for_svg('<svg></svg>') is None
+    selection = selection_for_svg(
+        '<svg><image href="$.referential.Home.picture.standard-big"/><text>$.query.q[0].my-col</text></svg>')
+    assert selection.reaches(('referential', 'Home', 'picture', 'standard-big'))
+    assert selection.reaches(('query', 'q', '[]', 'my-col'))
+    assert not selection.reaches(('referential', 'Home', 'picture', 'standard'))
+    assert selection_for_svg('<svg><text>$.query.q[0]-col</text></svg>') is None
+
+
+def test_resolve_prunes_unused_pictures(template, resolving_service):
+    tmpl = json.loads(template)
+    tmpl['svg'] = '<svg><image href="$.referential.Home.picture.standard"/></svg>'
+    service = resolving_service(template=json.dumps(tmpl))
+    service.referential.get_entity_picture.return_value = 'picture'
+    service.resolve('dsa_fbl_mt_duel', 'default', 'FR',
+                    False, {'match': {'id': 'f985507', 'event_or_entity': 'event'}}, None, 'my_user', True)
+    service.referential.get_entity_picture.assert_called_once_with('t153', 'default', 'standard', 'my_user', 'bitmap')
+    _, data = service.svg_builder.replace_jsonpath.call_args[0]
+    assert data == {'referential': {'Home': {'picture': {'standard': 'picture'}}}}
+
+
+def test_resolve_with_picture_store(tmpdir, template, resolving_service):
+    tmpl = json.loads(template)
+    tmpl['svg'] = '<svg><image href="$.referential.Home.picture.standard"/></svg>'
+    store = PictureStore(str(tmpdir))
+    service = resolving_service(template=json.dumps(tmpl), pictures=store)
+    service.referential.get_entity_picture.return_value = '<svg>picture</svg>'
+    service.resolve('dsa_fbl_mt_duel', 'default', 'FR',
+                    False, {'match': {'id': 'f985507', 'event_or_entity': 'event'}}, None, 'my_user', True)
+    _, data = service.svg_builder.replace_jsonpath.call_args[0]
+    reference = data['referential']['Home']['picture']['standard']
+    assert PictureStore.is_reference(reference)
+    assert store.put('<svg>picture</svg>') == reference
+    assert store.dereference(data)['referential']['Home']['picture']['standard'] == '<svg>picture</svg>'
+
+
+def test_resolve_with_compression(template, resolving_service):
+    tmpl = json.loads(template)
+    tmpl['svg'] = '<svg>{}</svg>'.format('<rect width="10" height="10"/>' * 100)
+    svg_builder = MagicMock(wraps=LocalSvgBuilder())
+    exporter = MagicMock(wraps=LocalExporter())
+    service = resolving_service(template=json.dumps(tmpl), codec=Codec(enabled=True, threshold=1024),
+                                svg_builder=svg_builder, exporter=exporter)
+    service.referential.get_entity_picture.return_value = 'picture'
+    result = service.resolve('dsa_fbl_mt_duel', 'default', 'FR',
+                             False, {'match': {'id': 'f985507', 'event_or_entity': 'event'}}, None, 'my_user', True)
+    assert result['content'] == tmpl['svg']
+    assert is_envelope(svg_builder.replace_jsonpath.call_args[0][0])
+    assert is_envelope(exporter.text_to_path.call_args[0][0])
+    assert Codec(enabled=True, threshold=1024).encode('<svg></svg>') == '<svg></svg>'
+
+def test_resolve_languages(resolving_service):
+    service = resolving_service()
+    service.referential.get_labels_by_id_and_language_and_context.side_effect = lambda label_id, language, context: {
+        'label': '{} ({})'.format(label_id, language)}
+    results = service.resolve_languages('dsa_fbl_mt_duel', 'default', ['FR', 'EN'],
+                                        True, {'match': {'id': 'f985507', 'event_or_entity': 'event'}}, None, 'my_user', True)
+    assert service.datareader.select.call_count == 3
+    assert service.referential.get_event_by_id.call_count == 1
+    fr = json.loads(results['FR']['content'])
+    en = json.loads(results['EN']['content'])
+    assert fr['query']['soccer_match_team_stats'][0]['type'] == 'possession_percentage (FR)'
+    assert en['query']['soccer_match_team_stats'][0]['type'] == 'possession_percentage (EN)'
+    assert fr['referential']['match']['display_name'] == 'Strasbourg - Marseille'
+    assert 'display_name' in en['referential']['Home']
+
+def test_resolve_bundle(template, query_results, resolving_service):
+    datareader = MagicMock(wraps=LocalDatareader(query_results))
+    service = resolving_service(datareader=datareader)
+    service.metadata.get_template.side_effect = lambda template_id, user: template if template_id == 'dsa_fbl_mt_duel' else 'null'
+    service.referential.get_entity_picture.return_value = 'picture'
+    referential = {'match': {'id': 'f985507', 'event_or_entity': 'event'}}
+    results = service.resolve_bundle([
+        {'template_id': 'dsa_fbl_mt_duel', 'picture_context': 'default', 'referential': referential, 'text_to_path': True},
+        {'template_id': 'dsa_fbl_mt_duel', 'language': 'EN', 'referential': referential, 'json_only': True},
+        {'template_id': 'unknown', 'referential': referential}
+    ], 'my_user')
+    assert [r['template_id'] for r in results] == ['dsa_fbl_mt_duel', 'dsa_fbl_mt_duel', 'unknown']
+    assert 'result' in results[0] and 'result' in results[1]
+    assert 'error' in results[2]
+    assert datareader.select_many.call_count == 1
+    assert len(datareader.select_many.call_args[0][0]) == 3
+    assert datareader.select.call_count == 0
+    assert service.metadata.get_query.call_count == 3
+    assert service.referential.get_event_by_id.call_count == 1
+
+
+def test_query_results_cache(resolving_service):
+    service = resolving_service()
+    service.metadata.get_fired_triggers.return_value = '[]'
+    referential = {'match': {'id': 'f985507', 'event_or_entity': 'event'}}
+    first = service.resolve('dsa_fbl_mt_duel', 'default', 'FR', True, referential, None, 'my_user', True)
+    second = service.resolve('dsa_fbl_mt_duel', 'default', 'FR', True, referential, None, 'my_user', True)
+    assert first == second
+    assert service.datareader.select.call_count == 3
+    assert service.referential.get_event_by_id.call_count == 1
+    service.handle_input_loaded('{"meta": {"source": "opta", "type": "f9", "content_id": "f985507"}, "id": "985507"}')
+    service.resolve('dsa_fbl_mt_duel', 'default', 'FR', True, referential, None, 'my_user', True)
+    assert service.datareader.select.call_count == 6
+    assert service.referential.get_event_by_id.call_count == 2
+
+
+def test_query_results_invalidated_while_selected(query_results, resolving_service):
+    service = resolving_service()
+    service.metadata.get_fired_triggers.return_value = '[]'
+
+    def select(sql, parameters, limit):
+        service.handle_input_loaded('{"meta": {"source": "opta", "type": "f9"}, "id": "985507"}')
+        return query_results(sql, parameters, limit)
+    service.datareader.select.side_effect = select
+    referential = {'match': {'id': 'f985507', 'event_or_entity': 'event'}}
+    first = service.resolve('dsa_fbl_mt_duel', 'default', 'FR', True, referential, None, 'my_user', True)
+    assert len(service.cache['query_results']) == 0
     service.datareader.select.side_effect = query_results
-    service.referential.get_labels_by_id_and_language_and_context.return_value = {'label': 'mylabel'}
+    assert service.resolve('dsa_fbl_mt_duel', 'default', 'FR', True, referential, None, 'my_user', True) == first
+    assert service.datareader.select.call_count == 6
+def test_prefetch_on_input_loaded(event, resolving_service):
+    config = {'PREFETCH': {
+        'enabled': True,
+        'users': ['my_user'],
+        'pictures': [{'context': 'default', 'format': 'standard'}],
+        'templates': [{'id': 'dsa_fbl_mt_duel', 'referential': {'match': {'from_event': True}}}]
+    }}
+    service = resolving_service(config=config)
     service.referential.get_entity_picture.return_value = 'picture'
+    service.metadata.get_fired_triggers.return_value = '[]'
+    service.handle_input_loaded('{"meta": {"source": "opta", "type": "f9", "content_id": "f985507"}, "id": "985507"}')
+    assert service.tasks.names == ['prefetch f985507']
+    assert service.datareader.select.call_count == 3
+    pictures = service.referential.get_entity_picture.call_count
+    assert pictures == len(json.loads(event)['entities'])
+
     service.resolve('dsa_fbl_mt_duel', 'default', 'FR',
                     False, {'match': {'id': 'f985507', 'event_or_entity': 'event'}}, None, 'my_user', True)
+    assert service.datareader.select.call_count == 3
+    assert service.referential.get_event_by_id.call_count == 1
+
 
-def test_handle_input_loaded(triggers, template, queries, event, entities, query_results, subscription):
-    service = worker_factory(TemplateService)
-    service.metadata.get_template.return_value = template
-    service.metadata.get_query.side_effect = queries
-    service.referential.get_event_by_id.return_value = event
+def test_stale_entities_are_refreshed_in_background(entities):
+    service = create_service()
     service.referential.get_entity_by_id.side_effect = entities
-    service.datareader.select.side_effect = query_results
-    service.referential.get_labels_by_id_and_language_and_context.return_value = {'label': 'mylabel'}
+    cache = service.cache['entities']
+    cache.set(('entity', 't144', 'my_user'), '{"id": "t144", "common_name": "OM"}', ttl=-1)
+    assert json.loads(service._get_entity('t144', 'my_user'))['common_name'] == 'OM'
+    assert service.tasks.names == ['refresh entities']
+    assert json.loads(service._get_entity('t144', 'my_user'))['common_name'] == 'Marseille'
+    assert service.referential.get_entity_by_id.call_count == 1
+
+def test_labelize_rows(entities):
+    service = create_service()
+    service.referential.get_entity_by_id.side_effect = entities
+    service.referential.get_labels_by_id_and_language_and_context.side_effect = lambda label_id, language, context: {
+        'label': label_id.upper()}
+    rows = [{'team_id': 't144', 'type': 'total_pass'}, {'team_id': 't153', 'type': 'total_pass'}, {'rank': 1}]
+    q = {'id': 'soccer_match_team_stats', 'labels': {'team_id': 'entity', 'type': 'label'}}
+    labelized = service._labelize_rows(rows, q, 'FR', 'soccer', 'my_user')
+    assert labelized[:2] == [{'team_id': 'Marseille', 'type': 'TOTAL_PASS'}, {'team_id': 'Strasbourg', 'type': 'TOTAL_PASS'}]
+    assert labelized[2] is rows[2]
+    assert rows[0] == {'team_id': 't144', 'type': 'total_pass'}
+    assert service.referential.get_labels_by_id_and_language_and_context.call_count == 1
+
+def test_resolve_columnar_query(template, query_results, resolving_service):
+    tmpl = json.loads(template)
+    tmpl['queries'][1]['format'] = 'columnar'
+    service = resolving_service(template=json.dumps(tmpl))
+    result = service.resolve('dsa_fbl_mt_duel', 'default', 'FR',
+                             True, {'match': {'id': 'f985507', 'event_or_entity': 'event'}}, None, 'my_user', True)
+    team_infos = json.loads(result['content'])['query']['soccer_match_team_infos']
+    assert team_infos['columns'] == ['side', 'team_id', 'score', 'competition_id', 'competition_flag']
+    assert team_infos['rows'][0] == ['Home', 't153', 1, 'c24', 'competition']
+    assert to_records(team_infos) == json.loads(query_results('SELECT SIDE', ['f985507'], 50))
+
+def test_referential_records_are_shared(template, resolving_service):
+    service = resolving_service()
+    service.referential.get_entity_picture.return_value = 'picture'
+    referential = {'match': {'id': 'f985507', 'event_or_entity': 'event'}}
+    tmpl = json.loads(template)
+    first = service._fetch_template_data(tmpl, 'default', False, referential, None, 'my_user')
+    second = service._fetch_template_data(tmpl, 'default', False, referential, None, 'my_user')
+    assert first['records']['Home'] is second['records']['Home']
+    assert first['referential']['Home'] is not second['referential']['Home']
+    assert 'picture' not in first['records']['Home'].document
+    assert 'match' in first['records'] and 'competition' in first['records']
+    localized = service._localize_template_data(first, tmpl, 'FR', 'my_user')
+    assert localized['referential']['Home']['display_name'] == 'Strasbourg'
+    assert first['records']['Home'].names['FR']['short_name'] == 'Strasbourg'
+
+def test_subscription_cache(subscription):
+    service = create_service()
+    service.subscription.get_subscription_by_user.return_value = subscription
+    sub = service._get_subscription('my_user')
+    assert sub['notification'] == {'channel': 'my_channel'}
+    assert sub['export']['target']['type'] == 's3'
+    assert service._get_subscription('my_user') == sub
+    assert service.subscription.get_subscription_by_user.call_count == 1
+    service.handle_subscription_updated('{"user": "my_user"}')
+    service.subscription.get_subscription_by_user.return_value = '{"user": "my_user", "subscription": {"notification": {}}}'
+    assert service._get_subscription('my_user') == {'export': None, 'notification': None}
+    assert service.subscription.get_subscription_by_user.call_count == 2
+
+
+def test_triggers_export_in_a_single_exporter_call(triggers, template, event, subscription, resolving_service):
+    local_exporter = LocalExporter()
+    exporter = MagicMock(wraps=local_exporter)
+    notifier = MagicMock()
+    service = resolving_service(svg_builder=LocalSvgBuilder(), exporter=exporter,
+                                notifications=Dispatcher(eventlet.spawn, notifier, window=0.05))
     service.referential.get_entity_picture.return_value = 'picture'
     service.metadata.get_fired_triggers.return_value = triggers
     service.referential.get_event_filtered_by_entities.return_value = event
     service.subscription.get_subscription_by_user.return_value = subscription
-    service.handle_input_loaded('{"meta": {"source": "opta", "type": "f9", "content_id": "f985507"}, "id": "985507"}')
\ No newline at end of file
+    payload = '{"meta": {"source": "opta", "type": "f9", "content_id": "f985507"}, "id": "985507"}'
+    service.handle_input_loaded(payload)
+    assert exporter.text_to_path_and_export.call_count == 2
+    assert local_exporter.files['export.png'] == json.loads(template)['svg']
+    assert exporter.text_to_path.call_count == 0
+    assert service.metrics.summary()['trigger_notify']['processed'] == 2
+    eventlet.sleep(0.1)
+    images = notifier.send_images_to_slack.call_args[0][1]
+    assert [image['context'] for image in images] == ['dsa_troyes_mt_duel', 'dsa_troyes_mt_duel_2']
+
+    exporter.text_to_path_and_export.side_effect = MethodNotFound('text_to_path_and_export')
+    del local_exporter.files['export.png']
+    service.handle_input_loaded(payload)
+    assert exporter.text_to_path.call_count == 2
+    assert local_exporter.files['export.png'] == json.loads(template)['svg']
+
+
+def test_template_queries_are_selected_together(query_results, resolving_service):
+    datareader = MagicMock(wraps=LocalDatareader(query_results))
+    service = resolving_service(datareader=datareader)
+    referential = {'match': {'id': 'f985507', 'event_or_entity': 'event'}}
+    batched = service.resolve('dsa_fbl_mt_duel', 'default', 'FR', True, referential, None, 'my_user', True)
+    assert datareader.select_many.call_count == 1
+    assert len(datareader.select_many.call_args[0][0]) == 3
+    assert datareader.select.call_count == 0
+
+    fallback = create_service(datareader=MagicMock(wraps=LocalDatareader(query_results)))
+    fallback.datareader.select_many.side_effect = MethodNotFound('select_many')
+    fallback.metadata = service.metadata
+    fallback.referential = service.referential
+    assert fallback.resolve('dsa_fbl_mt_duel', 'default', 'FR', True, referential, None, 'my_user', True) == batched
+    assert fallback.datareader.select.call_count == 3
+
+    def failing_select(sql, parameters, limit):
+        if sql.startswith('WITH'):
+            raise ValueError('syntax error')
+        return query_results(sql, parameters, limit)
+    failing = create_service(datareader=MagicMock(wraps=LocalDatareader(failing_select)))
+    failing.metadata = service.metadata
+    failing.referential = service.referential
+    with pytest.raises(TemplateServiceError):
+        failing.resolve('dsa_fbl_mt_duel', 'default', 'FR', True, referential, None, 'my_user', True)
+    assert failing.datareader.select_many.call_count == 1
+    assert failing.datareader.select.call_count == 0
+
+
+def test_content_addressed_datasources(template, subscription, resolving_service):
+    tmpl = json.loads(template)
+    tmpl['kind'] = 'html'
+    tmpl['html'] = '<script src="${DATASOURCE}"></script>'
+    local_exporter = LocalExporter()
+    exporter = MagicMock(wraps=local_exporter)
+    service = resolving_service(template=json.dumps(tmpl), exporter=exporter,
+                                config={'CONTENT_ADDRESSED_DATASOURCES': True})
+    service.referential.get_labels_by_id_and_language_and_context.side_effect = lambda i, l, c: {'label': i + l}
+    service.referential.get_entity_picture.return_value = 'picture'
+    service.subscription.get_subscription_by_user.return_value = subscription
+    referential = {'match': {'id': 'f985507', 'event_or_entity': 'event'}}
+    first = service.resolve('dsa_fbl_mt_duel', None, 'FR', False, referential, None, 'my_user', False)
+    second = service.resolve('dsa_fbl_mt_duel', None, 'FR', False, referential, None, 'my_user', False)
+    assert first == second
+    assert exporter.upload.call_count == 1
+    filename = exporter.upload.call_args[0][1]
+    assert first['content'] == '<script src="https://uploads.local/{}"></script>'.format(filename)
+    assert json.loads(local_exporter.files[filename])['query']['soccer_match_infos'][0]['attendance'] == 25962
+
+    service.resolve('dsa_fbl_mt_duel', None, 'EN', False, referential, None, 'my_user', False)
+    assert exporter.upload.call_count == 2
+
+
+def test_pipeline_stages():
+    metrics = Metrics()
+    exported = list()
+
+    def resolve(item):
+        if item == 3:
+            raise ValueError('boom')
+        return None if item == 5 else item * 10
+
+    def export(item):
+        eventlet.sleep(0.01)
+        exported.append(item)
+
+    Pipeline([Stage('resolve', resolve, metrics.stage('resolve'), concurrency=4, maxsize=8),
+              Stage('export', export, metrics.stage('export'), concurrency=1, maxsize=2)]).run(range(8))
+    assert sorted(exported) == [0, 10, 20, 40, 60, 70]
+    summary = metrics.summary()
+    assert summary['resolve']['processed'] == 7
+    assert summary['resolve']['failed'] == 1
+    assert summary['export']['processed'] == 6
+    assert summary['export']['max_queue_depth'] <= 2
+    assert summary['export']['queue_depth'] == 0
+    assert summary['export']['throughput'] > 0
+
+
+def test_prerendered_outputs(template, resolving_service):
+    service = resolving_service(svg_builder=LocalSvgBuilder(), exporter=LocalExporter())
+    service.referential.get_entity_picture.return_value = 'picture'
+    service.metadata.get_fired_triggers.return_value = '[]'
+    specs = [{'id': 'dsa_fbl_mt_duel', 'languages': ['FR', 'EN'], 'text_to_path': True,
+              'referential': {'match': {'from_event': True}}}]
+    assert service.prerender('f985507', specs, 'my_user') == 2
+    assert service.tasks.names == ['prerender dsa_fbl_mt_duel'] * 2
+    selects = service.datareader.select.call_count
+
+    referential = {'match': {'id': 'f985507', 'event_or_entity': 'event'}}
+    result = service.resolve('dsa_fbl_mt_duel', None, 'EN', False, referential, None, 'my_user', True)
+    assert result == {'content': json.loads(template)['svg'], 'mimetype': 'image/svg+xml'}
+    assert service.datareader.select.call_count == selects
+
+    service.handle_input_loaded('{"meta": {"source": "opta", "type": "f9"}, "id": "985507"}')
+    service.resolve('dsa_fbl_mt_duel', None, 'EN', False, referential, None, 'my_user', True)
+    assert service.datareader.select.call_count > selects
+
+    service._render_template = MagicMock(return_value=({'content': '{}', 'mimetype': 'application/json'}, []))
+    service.prerender('f985507', [{'id': 'dsa_fbl_mt_duel', 'json_only': True}], 'my_user')
+    assert service.resolve('dsa_fbl_mt_duel', None, 'FR', True, None, None, 'my_user', False)['content'] == '{}'
+    assert service._render_template.call_count == 1
+
+
+def test_triggers_rerun_only_the_queries_of_the_loaded_source(triggers, queries, event, subscription,
+                                                               resolving_service):
+    config = {
+        'QUERY_SOURCES': {'SOCCER_MATCHINFO': {'source': 'opta', 'type': 'f1'},
+                          'soccer_teamstat': {'source': 'opta', 'type': 'f9'}},
+        'TRIGGER_PIPELINE': {'resolve': {'concurrency': 1}}
+    }
+    service = resolving_service(config=config)
+    service.referential.get_entity_picture.return_value = 'picture'
+    service.metadata.get_fired_triggers.return_value = triggers
+    service.referential.get_event_filtered_by_entities.return_value = event
+    service.subscription.get_subscription_by_user.return_value = subscription
+    assert service._get_query_sources(json.loads(queries('soccer_match_team_stats'))) == [('opta', 'f9')]
+
+    service.handle_input_loaded('{"meta": {"source": "opta", "type": "f9", "content_id": "f985507"}, "id": "1"}')
+    assert service.datareader.select.call_count == 3
+    service.cache['query_results'].clear()
+    service.handle_input_loaded('{"meta": {"source": "opta", "type": "f1", "content_id": "f985507"}, "id": "2"}')
+    assert service.datareader.select.call_count == 4
+    assert service.datareader.select.call_args[0][0].startswith('SELECT M.ATTENDANCE')
+
+
+def test_trigger_queue_is_shared_across_events():
+    queue = FairQueue()
+    config = {'TRIGGER_PIPELINE': {'resolve': {'concurrency': 1, 'queue_size': 1}}}
+    refreshed = list()
+
+    def resolver(index):
+        def resolve(job):
+            eventlet.sleep(0.005)
+            refreshed.append((index, job['trigger']['user'], job['content_id']))
+        return resolve
+    services = [create_service(trigger_queue=queue, config=config) for _ in range(2)]
+    for index, service in enumerate(services):
+        service._resolve_trigger = resolver(index)
+    heavy = eventlet.spawn(services[0]._run_trigger_pipeline,
+                           [{'trigger': {'user': 'heavy_user'}, 'content_id': 'e1'}] * 10)
+    eventlet.sleep(0.012)
+    light = eventlet.spawn(services[1]._run_trigger_pipeline,
+                           [{'trigger': {'user': 'heavy_user'}, 'content_id': 'e2'}] * 10 +
+                           [{'trigger': {'user': 'my_user'}, 'content_id': 'e2'}] * 2)
+    heavy.wait()
+    light.wait()
+    assert len(refreshed) == 22 and len(queue) == 0
+    assert max(i for i, (_, user, _) in enumerate(refreshed) if user == 'my_user') < 10
+    assert any(index == 0 and content_id == 'e2' for index, _, content_id in refreshed)
+
+
+def test_stats(resolving_service):
+    service = resolving_service(metrics=Metrics(max_workers=10), notifications=Dispatcher(eventlet.spawn))
+    service.resolve('dsa_fbl_mt_duel', 'default', 'FR', True, {'match': {'id': 'f985507', 'event_or_entity': 'event'}},
+                    None, 'my_user', True)
+    service.metrics.worker_started('stats')
+    stats = service.stats()
+    assert stats['workers'] == {'in_flight': {'stats': 1}, 'active': 1, 'max_workers': 10, 'usage': 0.1}
+    assert stats['caches']['query_results']['misses'] == 3
+    assert stats['serialization']['loads_bson']['inline'] == 3
+    assert stats['notifications'] == {}
+    assert set(stats['downstreams']) == set(TemplateService.downstreams)
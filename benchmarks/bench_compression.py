@@ -0,0 +1,58 @@
+""" Compares RPC payloads sent to svg_builder and exporter with and without the compression envelope.
+
+Broker bandwidth is measured as the size of the JSON message body nameko publishes, latency as the
+encoding and decoding CPU time plus the transfer time of that body at the given bandwidth.
+
+    python -m benchmarks.bench_compression [bandwidth in MB/s]
+"""
+import json
+import random
+import sys
+import time
+
+from application.dependencies.compression import Codec, decode
+
+SIZES = (16 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024)
+
+
+def make_svg(size):
+    rnd = random.Random(size)
+    parts = ['<svg xmlns="http://www.w3.org/2000/svg">']
+    length = len(parts[0])
+    while length < size:
+        part = '<path d="M{} {} L{} {} Z" fill="#{:06x}"/><text x="{}" y="{}">{}</text>'.format(
+            rnd.randint(0, 999), rnd.randint(0, 999), rnd.randint(0, 999), rnd.randint(0, 999),
+            rnd.randint(0, 0xffffff), rnd.randint(0, 999), rnd.randint(0, 999), rnd.choice(
+                ('Strasbourg', 'Marseille', 'possession_percentage', 'total_pass')))
+        parts.append(part)
+        length += len(part)
+    parts.append('</svg>')
+    return ''.join(parts)
+
+
+def measure(codec, svg, repeat=5):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = json.dumps({'args': [codec.encode(svg)], 'kwargs': {}})
+        assert decode(json.loads(body)['args'][0]) == svg
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(body), best
+
+
+def main(bandwidth):
+    print('{:>10} {:>12} {:>12} {:>10} {:>10} {:>10} {:>10}'.format(
+        'svg', 'plain bytes', 'zlib bytes', 'ratio', 'plain ms', 'zlib ms', 'gain ms'))
+    for size in SIZES:
+        svg = make_svg(size)
+        plain_bytes, plain_cpu = measure(Codec(), svg)
+        zlib_bytes, zlib_cpu = measure(Codec(enabled=True), svg)
+        plain_ms = (plain_cpu + plain_bytes / bandwidth) * 1000
+        zlib_ms = (zlib_cpu + zlib_bytes / bandwidth) * 1000
+        print('{:>10} {:>12} {:>12} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+            size, plain_bytes, zlib_bytes, plain_bytes / zlib_bytes, plain_ms, zlib_ms, plain_ms - zlib_ms))
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 50 * 1024 * 1024)
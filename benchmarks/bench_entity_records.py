@@ -0,0 +1,83 @@
+""" Measures the memory held by the referential results of concurrent resolves referencing hundreds of players.
+
+The former implementation decoded a document per request and per reference, the shared records are
+decoded once per version and only shallow copied by each request.
+
+    python -m benchmarks.bench_entity_records
+"""
+import gc
+import json
+import time
+import tracemalloc
+
+import bson.json_util
+from nameko.testing.services import worker_factory
+
+from application.dependencies.cache import Caches
+from application.dependencies.compression import Codec
+from application.services.template import TemplateService
+from application.tests.standins import InlineTasks
+
+PLAYERS = 300
+REQUESTS = 20
+
+
+def make_player(i):
+    return json.dumps({
+        'id': 'p{}'.format(i),
+        'provider': 'opta_f9',
+        'type': 'soccer player',
+        'common_name': 'Player {}'.format(i),
+        'informations': {'id': 'p{}'.format(i), 'first_name': 'First{}'.format(i), 'last_name': 'Last{}'.format(i),
+                         'known': None, 'position': 'Midfielder', 'birth_date': '1990-01-01', 'country': 'France',
+                         'height': 180, 'weight': 75, 'jersey_num': i % 30},
+        'internationalization': {'EN': 'Player {} (EN)'.format(i)},
+        'history': [{'team_id': 't{}'.format(j), 'season': str(2000 + j), 'appearances': j} for j in range(10)]
+    })
+
+
+def decoded_referential(service, raws, language):
+    results = dict()
+    for raw in raws:
+        entity = bson.json_util.loads(raw)
+        entity['display_name'] = service._get_display_name(entity, language)
+        entity['short_name'] = service._get_short_name(entity, language)
+        entity['multiline_name'] = service._get_multiline_name(entity, language)
+        results[entity['id']] = entity
+    return results
+
+
+def record_referential(service, raws, language):
+    results = dict()
+    for raw in raws:
+        record = service._get_record(raw)
+        results[record.document['id']] = dict(record.document, **record.localized_names(language, service._get_names))
+    return results
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    started = time.process_time()
+    held = [build(language) for language in ['FR', 'EN'] * (REQUESTS // 2)]
+    elapsed = time.process_time() - started
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del held
+    return elapsed, current
+
+
+def main():
+    service = worker_factory(TemplateService, pictures=None, codec=Codec(), cache=Caches(), tasks=InlineTasks(),
+                             config={})
+    raws = [make_player(i) for i in range(PLAYERS)]
+    decoded_cpu, decoded_mem = measure(lambda language: decoded_referential(service, raws, language))
+    record_cpu, record_mem = measure(lambda language: record_referential(service, raws, language))
+    print('{} players referenced by {} concurrent resolves'.format(PLAYERS, REQUESTS))
+    print('{:>10} {:>10} {:>10}'.format('', 'cpu s', 'held KB'))
+    print('{:>10} {:>10.3f} {:>10.0f}'.format('decoded', decoded_cpu, decoded_mem / 1024.))
+    print('{:>10} {:>10.3f} {:>10.0f}'.format('records', record_cpu, record_mem / 1024.))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+""" Compares the column-wise labelization of query results with the former row by row implementation.
+
+Labels and entities are served by an in-memory referential so that only the labelization itself is
+measured, as it is once the referential lookups are cached.
+
+    python -m benchmarks.bench_labelize
+"""
+import gc
+import json
+import time
+import tracemalloc
+
+import bson.json_util
+from nameko.testing.services import worker_factory
+
+from application.dependencies.cache import Caches
+from application.dependencies.compression import Codec
+from application.services.template import TemplateService
+from application.tests.standins import InlineTasks
+
+ROW_COUNTS = (10000, 50000, 100000)
+QUERY = {'id': 'soccer_player_stats', 'labels': {'type': 'label', 'player_id': 'entity', 'team_id': 'entity'}}
+
+
+class MemoryReferential(object):
+
+    def get_entity_by_id(self, entity_id, user):
+        return json.dumps({'id': entity_id, 'common_name': 'Entity {}'.format(entity_id)})
+
+    def get_labels_by_id_and_language_and_context(self, label_id, language, context):
+        return {'id': label_id, 'label': label_id.replace('_', ' ')}
+
+
+def labelize_row(service, row, q, language, context, user):
+    labelized_row = row.copy()
+    if 'labels' not in q or not q['labels']:
+        return labelized_row
+    current_labels = q['labels']
+    for lab in current_labels:
+        if lab not in row:
+            continue
+        if current_labels[lab] == 'entity':
+            current_entity = bson.json_util.loads(
+                service._get_entity(row[lab], user))
+            labelized_row[lab] = current_entity['common_name']
+        elif current_labels[lab] == 'label':
+            current_label = service._get_label(
+                row[lab], language, context)
+            labelized_row[lab] = current_label['label']
+    return labelized_row
+
+
+def make_rows(count):
+    types = ['total_pass', 'accurate_pass', 'duel_won', 'duel_lost', 'total_scoring_att', 'won_contest']
+    return [{'player_id': 'p{}'.format(i % 300), 'team_id': 't{}'.format(i % 20), 'type': types[i % len(types)],
+             'value': i, 'rank': i % 50} for i in range(count)]
+
+
+def measure(fn):
+    gc.collect()
+    tracemalloc.start()
+    started = time.process_time()
+    fn()
+    elapsed = time.process_time() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    service = worker_factory(TemplateService, pictures=None, codec=Codec(), cache=Caches(), tasks=InlineTasks(),
+                             config={}, referential=MemoryReferential())
+    print('{:>8} {:>12} {:>12} {:>14} {:>14}'.format('rows', 'row cpu s', 'column cpu s', 'row peak KB', 'column peak KB'))
+    for count in ROW_COUNTS:
+        rows = make_rows(count)
+        row_cpu, row_peak = measure(lambda: [labelize_row(service, r, QUERY, 'FR', 'soccer', 'my_user') for r in rows])
+        col_cpu, col_peak = measure(lambda: service._labelize_rows(rows, QUERY, 'FR', 'soccer', 'my_user'))
+        print('{:>8} {:>12.3f} {:>12.3f} {:>14.0f} {:>14.0f}'.format(
+            count, row_cpu, col_cpu, row_peak / 1024., col_peak / 1024.))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+""" Measures how long the eventlet hub is stalled while a large query result is decoded then encoded.
+
+A ticker green thread records the longest gap between its ticks, standing for the unrelated requests
+served by the same container.
+
+    python -m benchmarks.bench_serialization
+"""
+import datetime
+import json
+import time
+
+import eventlet
+
+from application.dependencies.serialization import DateEncoder, ProcessPool, Serializer
+
+ROWS = 100000
+
+
+class Ticker(object):
+
+    def __init__(self):
+        self.ticks = 0
+        self.max_gap = 0.
+        self.running = True
+
+    def run(self):
+        last = time.perf_counter()
+        while self.running:
+            eventlet.sleep(0.01)
+            now = time.perf_counter()
+            self.max_gap = max(self.max_gap, now - last)
+            self.ticks += 1
+            last = now
+
+
+def measure(serializer, raw):
+    ticker = Ticker()
+    thread = eventlet.spawn(ticker.run)
+    eventlet.sleep(0.05)
+    started = time.perf_counter()
+    rows = serializer.loads_bson(raw)
+    serializer.dumps(rows, len(raw))
+    elapsed = time.perf_counter() - started
+    ticker.running = False
+    thread.wait()
+    return elapsed, ticker.ticks, ticker.max_gap
+
+
+def main():
+    start = datetime.datetime(2019, 5, 3, 18, 45)
+    raw = json.dumps([{'id': 'p{}'.format(i), 'date': start + datetime.timedelta(minutes=i), 'team_id': 't153',
+                       'value': i * 0.5, 'rank': i} for i in range(ROWS)], cls=DateEncoder)
+    pool = ProcessPool(2)
+    try:
+        results = [('inline', measure(Serializer(), raw)), ('offloaded', measure(Serializer(pool), raw))]
+    finally:
+        pool.close()
+    print('{} rows, {:.1f} MB'.format(ROWS, len(raw) / 1024. / 1024.))
+    print('{:>10} {:>10} {:>10} {:>12}'.format('', 'wall s', 'ticks', 'max gap s'))
+    for name, (elapsed, ticks, max_gap) in results:
+        print('{:>10} {:>10.3f} {:>10} {:>12.3f}'.format(name, elapsed, ticks, max_gap))
+
+
+if __name__ == '__main__':
+    main()
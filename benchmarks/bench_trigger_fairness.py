@@ -0,0 +1,119 @@
+""" Measures the refresh latency of each user's triggers when one user owns most of the triggers fired by
+concurrent events.
+
+Events arrive every EVENT_INTERVAL seconds, each firing the triggers of a heavy user and of one light user, and
+are handled by at most WORKERS workers at once. Triggers go through a resolve stage then an export stage, both
+waiting on downstream services of limited capacity. Each event either runs its own pipeline over its triggers
+interleaved by user (per event), or queues its triggers in a queue shared by the pipelines of all the events,
+leaving them to PIPELINES running pipelines (shared). The resolve stage takes triggers one at a time so that
+they wait in the queue they come from. Latencies are counted from the arrival of the event.
+
+    python -m benchmarks.bench_trigger_fairness
+"""
+import time
+
+import eventlet
+from eventlet.semaphore import Semaphore
+
+from application.dependencies.metrics import Metrics
+from application.dependencies.scheduling import FairQueue
+from application.services.pipeline import Pipeline, Stage
+
+EVENTS = 8
+WORKERS = 3
+PIPELINES = 2
+EVENT_INTERVAL = 0.05
+HEAVY_TRIGGERS = 20
+LIGHT_TRIGGERS = 2
+RESOLVE_SECONDS = 0.02
+RESOLVE_CAPACITY = 4
+EXPORT_SECONDS = 0.01
+EXPORT_CAPACITY = 2
+
+
+def interleave(items, key):
+    """ Orders items by round robin over their keys, as a single event did before the shared queue """
+    queue = FairQueue()
+    for item in items:
+        queue.put(key(item), item)
+    return list(iter(queue.pop, None))
+
+
+def event_triggers(event):
+    return [('heavy_user', event, i) for i in range(HEAVY_TRIGGERS)] + \
+        [('user_{}'.format(event), event, i) for i in range(LIGHT_TRIGGERS)]
+
+
+def run(shared):
+    started = time.perf_counter()
+    arrivals = dict()
+    latencies = dict()
+    resolver = Semaphore(RESOLVE_CAPACITY)
+    exporter = Semaphore(EXPORT_CAPACITY)
+    queue = FairQueue()
+    metrics = Metrics()
+
+    def resolve(job):
+        with resolver:
+            eventlet.sleep(RESOLVE_SECONDS)
+        return job
+
+    def export(job):
+        with exporter:
+            eventlet.sleep(EXPORT_SECONDS)
+        latencies.setdefault(job[0], list()).append(time.perf_counter() - arrivals[job[1]])
+
+    def handle(event):
+        jobs = event_triggers(event)
+        pipeline = Pipeline([Stage('resolve', resolve, metrics.stage('resolve'), concurrency=4, maxsize=1),
+                             Stage('export', export, metrics.stage('export'), concurrency=2, maxsize=4)])
+        if shared:
+            for job in jobs:
+                queue.put(job[0], job)
+            if queue.consumers < PIPELINES:
+                pipeline.run(queue.drain())
+        else:
+            pipeline.run(interleave(jobs, lambda job: job[0]))
+
+    workers = Semaphore(WORKERS)
+
+    def worker(event):
+        with workers:
+            handle(event)
+
+    threads = list()
+    for event in range(EVENTS):
+        arrivals[event] = time.perf_counter()
+        threads.append(eventlet.spawn(worker, event))
+        eventlet.sleep(EVENT_INTERVAL)
+    for thread in threads:
+        thread.wait()
+    return latencies, time.perf_counter() - started
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100. * (len(ordered) - 1))))]
+
+
+def light(latencies):
+    return [latency for user, values in latencies.items() if user != 'heavy_user' for latency in values]
+
+
+def main():
+    per_event, per_event_elapsed = run(shared=False)
+    shared, shared_elapsed = run(shared=True)
+    print('{} events every {}s on {} workers, {} heavy and {} light triggers each, resolve {}s x{}, export {}s x{}'.format(
+        EVENTS, EVENT_INTERVAL, WORKERS, HEAVY_TRIGGERS, LIGHT_TRIGGERS, RESOLVE_SECONDS, RESOLVE_CAPACITY, EXPORT_SECONDS,
+        EXPORT_CAPACITY))
+    print('{:>12} {:>10} {:>8} {:>8} {:>10} {:>8} {:>8}'.format(
+        '', 'event p50', 'p95', 'max', 'shared p50', 'p95', 'max'))
+    for user, a, b in (('heavy_user', per_event['heavy_user'], shared['heavy_user']),
+                       ('light users', light(per_event), light(shared))):
+        print('{:>12} {:>10.3f} {:>8.3f} {:>8.3f} {:>10.3f} {:>8.3f} {:>8.3f}'.format(
+            user, percentile(a, 50), percentile(a, 95), max(a), percentile(b, 50), percentile(b, 95), max(b)))
+    print('{:>12} {:>10.3f} {:>26.3f}'.format('total', per_event_elapsed, shared_elapsed))
+
+
+if __name__ == '__main__':
+    main()